@@ -3,21 +3,40 @@
 
 """Tests for the `dicts` module of `zkpytb` package."""
 
+import copy
+import hashlib
 import pytest
+import random
 import sys
+from collections import OrderedDict
 
 
 from zkpytb.dicts import (
+    MISSING,
     AutoDict,
+    AutoDictPeekView,
+    AutoDictView,
     AutoOrderedDict,
+    DictFilter,
+    FlatAutoDict,
     filter_dict_callfunc,
     filter_dict_only_scalar_values,
     filter_dict_with_keylist,
+    MergeConflictError,
+    merge_dicts,
     mergedicts,
+    MerkleAutoDict,
+    MerkleAutoOrderedDict,
+    merkle_hashdict,
     dict_stable_json_repr,
     hashdict,
+    hashdicts,
     dict_values_map,
+    dict_values_map_batch,
+    records_to_columns,
+    columns_to_records,
 )
+from zkpytb.json import canonical_dumps
 
 
 def dummyfunc():
@@ -137,6 +156,59 @@ def test_filter_dict_with_keylist_blacklist(dict1):
     assert res_keys == orig_keys - set(blacklist)
 
 
+def test_filter_dict_with_keylist_unhashable(dict1):
+    res = filter_dict_with_keylist(dict1, ['a', 'd', ['x']])
+    assert sorted(list(res.keys())) == ['a', 'd']
+
+
+def test_dict_filter_unhashable(dict1):
+    res = DictFilter(['a', 'd', ['x']])(dict1)
+    assert sorted(list(res.keys())) == ['a', 'd']
+    res = DictFilter(iter(['a', 'd', ['x']]), blacklistmode=True)(dict1)
+    assert res == filter_dict_with_keylist(dict1, ['a', 'd', ['x']], blacklistmode=True)
+
+
+def test_dict_filter_not_a_callable(not_a_callable):
+    if not_a_callable is None:
+        pytest.skip('None means no func')
+    with pytest.raises(AssertionError):
+        DictFilter(func=not_a_callable)
+
+
+def test_dict_filter_same_as_filter_dict_functions(dict1, dict3):
+    func = lambda k, v: k in 'abfn'  # noqa: E731
+    for d in (dict1, dict3, {}):
+        assert DictFilter()(d) == d
+        assert DictFilter(func=func)(d) == filter_dict_callfunc(d, func)
+        assert DictFilter(only_scalar_values=True)(d) == filter_dict_only_scalar_values(d)
+        assert DictFilter(keylist=['a', 'd', 'max'])(d) == filter_dict_with_keylist(d, ['a', 'd', 'max'])
+        assert DictFilter(keylist=('a', 'd'), blacklistmode=True)(d) == \
+            filter_dict_with_keylist(d, ['a', 'd'], blacklistmode=True)
+
+
+def test_dict_filter_combined(dict1):
+    dict_filter = DictFilter(keylist=['a', 'c', 'e', 'f', 'x'], only_scalar_values=True,
+                             func=lambda k, v: v is not None)
+    res = dict_filter(dict1)
+    assert res == {'a': 1, 'f': dummyfunc}
+    assert list(DictFilter(keylist={'a', 'c'}, blacklistmode=True, only_scalar_values=True)(dict1)) == \
+        ['b', 'f', 'n']
+
+
+def test_dict_filter_many_batch_inplace(dict1, dict3):
+    dict_filter = DictFilter(keylist=['a', 'max', 'min'])
+    stream = dict_filter.filter_many(iter([dict1, dict3]))
+    assert next(stream) == {'a': 1}
+    assert next(stream) == {'max': 3357, 'min': 167}
+    assert dict_filter.filter_batch([dict3, {}]) == [{'max': 3357, 'min': 167}, {}]
+    d = dict(dict1)
+    dict_filter.filter_inplace(d)
+    assert d == {'a': 1}
+    d = {'a': 1}
+    dict_filter.filter_inplace(d)
+    assert d == {'a': 1}
+
+
 def test_mergedicts_1(dict1, dict2):
     res = dict(mergedicts(dict1, dict2))
     expected_res = {
@@ -157,6 +229,140 @@ def test_mergedicts_not_a_dict(dict1, not_a_dict):
         dict(mergedicts(dict1, not_a_dict))
 
 
+def test_mergedicts_key_order(dict1, dict2):
+    res = list(k for k, _ in mergedicts(dict1, dict2))
+    assert res == ['a', 'b', 'c', 'd', 'e', 'f', 'n', 'x']
+
+
+def test_merge_dicts_reuses_subtrees(dict1, dict2):
+    res = merge_dicts(dict1, dict2)
+    assert res == dict(mergedicts(dict1, dict2))
+    assert res['c'] is dict1['c']
+    assert res['e'] is not dict1['e']
+    assert res['e']['e3'] is dict2['e']['e3']
+    assert dict1['e'] == {'e1': None, 'e2': 'test'}
+    assert merge_dicts() == {}
+    assert merge_dicts(dict1) == dict1
+    assert merge_dicts(dict1) is not dict1
+
+
+def test_merge_dicts_many():
+    defaults = {'db': {'host': 'localhost', 'port': 5432, 'opts': {'a': 1}}, 'debug': False, 'tags': ['x']}
+    site = {'db': {'host': 'db.site'}, 'tags': ['y']}
+    host = {'db': {'opts': {'b': 2}}, 'name': 'host1'}
+    runtime = {'debug': True, 'db': {'opts': {'a': 3}}}
+    res = merge_dicts(defaults, site, host, runtime)
+    assert res == {
+        'db': {'host': 'db.site', 'port': 5432, 'opts': {'a': 3, 'b': 2}},
+        'debug': True,
+        'tags': ['y'],
+        'name': 'host1',
+    }
+    assert list(res) == ['db', 'debug', 'tags', 'name']
+    # none of the inputs have been modified
+    assert defaults == {'db': {'host': 'localhost', 'port': 5432, 'opts': {'a': 1}}, 'debug': False, 'tags': ['x']}
+    assert host == {'db': {'opts': {'b': 2}}, 'name': 'host1'}
+    assert runtime == {'debug': True, 'db': {'opts': {'a': 3}}}
+
+
+def test_merge_dicts_borrowed_subtree_not_modified():
+    d1 = {'a': 1}
+    d2 = {'b': {'c': {'d': 1}}}
+    d3 = {'b': {'c': {'e': 2}}}
+    for inplace in (False, True):
+        res = merge_dicts(d1.copy(), d2, d3, inplace=inplace)
+        assert res == {'a': 1, 'b': {'c': {'d': 1, 'e': 2}}}
+        assert d2 == {'b': {'c': {'d': 1}}}
+        assert d3 == {'b': {'c': {'e': 2}}}
+    # the copy of a borrowed dict made by a first merge must not make its subtrees writable
+    d2 = {'b': {'c': {'x': 1}}}
+    res = merge_dicts({}, d2, {'b': {'y': 1}}, {'b': {'c': {'z': 2}}}, inplace=True)
+    assert res == {'b': {'c': {'x': 1, 'z': 2}, 'y': 1}}
+    assert d2 == {'b': {'c': {'x': 1}}}
+
+
+def test_merge_dicts_later_dicts_never_modified():
+    rng = random.Random(0)
+
+    def random_dict(depth):
+        d = {}
+        for _ in range(rng.randrange(4)):
+            key = rng.choice('abc')
+            d[key] = random_dict(depth - 1) if depth and rng.random() < 0.6 else rng.randrange(3)
+        return d
+
+    for _ in range(2000):
+        dicts = [random_dict(3) for _ in range(rng.randrange(1, 5))]
+        expected = merge_dicts(*copy.deepcopy(dicts))
+        later = copy.deepcopy(dicts[1:])
+        for inplace in (False, True):
+            first = copy.deepcopy(dicts[0])
+            assert merge_dicts(first, *dicts[1:], inplace=inplace) == expected
+            assert dicts[1:] == later
+
+
+def test_merge_dicts_overriding_subtree_not_modified():
+    d2 = {'a': {'x': 1}}
+    d3 = {'a': {'y': 2}}
+    for conflict in ('override', lambda path, old, new: new):
+        for inplace in (False, True):
+            res = merge_dicts({'a': 1}, d2, d3, conflict=conflict, inplace=inplace)
+            assert res == {'a': {'x': 1, 'y': 2}}
+            assert d2 == {'a': {'x': 1}}
+            assert d3 == {'a': {'y': 2}}
+
+
+def test_merge_dicts_inplace(dict1, dict2):
+    target = {'e': {'e1': None, 'e2': 'test'}, 'y': 1}
+    nested = target['e']
+    res = merge_dicts(target, dict2, inplace=True)
+    assert res is target
+    assert res['e'] is nested
+    assert nested == {'e1': None, 'e2': 'test2', 'e3': {'e3a': 0, 'e3b': [None]}}
+    assert res['e']['e3'] is dict2['e']['e3']
+    assert list(res) == ['e', 'y', 'x']
+
+
+def test_merge_dicts_conflict_strategies():
+    d1 = {'a': [1], 'b': {'c': 1, 'l': [1, 2]}, 'x': 'x'}
+    d2 = {'a': [2], 'b': {'c': 2, 'l': [3]}, 'x': {'y': 1}}
+    assert merge_dicts(d1, d2) == {'a': [2], 'b': {'c': 2, 'l': [3]}, 'x': {'y': 1}}
+    assert merge_dicts(d1, d2, conflict='append') == {'a': [1, 2], 'b': {'c': 2, 'l': [1, 2, 3]}, 'x': {'y': 1}}
+    assert d1['b']['l'] == [1, 2]
+    conflicts = []
+
+    def keep_old(path, old, new):
+        conflicts.append(path)
+        return old
+
+    assert merge_dicts(d1, d2, conflict=keep_old) == d1
+    assert sorted(conflicts) == [('a',), ('b', 'c'), ('b', 'l'), ('x',)]
+    with pytest.raises(MergeConflictError) as excinfo:
+        merge_dicts({'b': {'c': 1}}, {'b': {'c': 2}}, conflict='raise')
+    assert excinfo.value.path == ('b', 'c')
+    assert excinfo.value.old == 1
+    assert excinfo.value.new == 2
+    assert merge_dicts({'b': {'c': 1}}, {'b': {'d': 2}}, conflict='raise') == {'b': {'c': 1, 'd': 2}}
+    with pytest.raises(ValueError):
+        merge_dicts(d1, d2, conflict='unknown')
+
+
+def test_merge_dicts_deep():
+    depth = sys.getrecursionlimit() * 2
+    d1, d2 = {}, {}
+    n1, n2 = d1, d2
+    for i in range(depth):
+        n1['a'] = i
+        n2['b'] = i
+        n1['x'] = n1 = {}
+        n2['x'] = n2 = {}
+    node = merge_dicts(d1, d2)
+    for i in range(depth):
+        assert node['a'] == node['b'] == i
+        node = node['x']
+    assert node == {}
+
+
 def test_hashdict_not_a_dict(not_a_dict):
     with pytest.raises(AssertionError):
         hashdict(not_a_dict)
@@ -219,6 +425,124 @@ def test_hashdict_2():
 def test_hashdict_3():
     with pytest.raises(TypeError):
         hashdict({'lambda': lambda x: x})
+    with pytest.raises(TypeError):
+        hashdict({'lambda': lambda x: x}, streaming=True)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 10, 65536])
+def test_hashdict_streaming(dict2, chunk_size):
+    assert hashdict(dict2, streaming=True, chunk_size=chunk_size) == hashdict(dict2)
+    assert hashdict(dict2, method='md5', streaming=True, chunk_size=chunk_size) == 'e1926c486437ca20489d4c35210db768'
+    d = {'nested': [{'key%d' % i: [i, str(i) * i, {'x': 1.5 * i, 'y': None}]} for i in range(200)], 'unicode': 'é€😀'}
+    assert hashdict(d, streaming=True, chunk_size=chunk_size) == hashdict(d)
+
+
+def test_hashdict_canonical(dict2):
+    expected = hashlib.sha1(canonical_dumps(dict2, as_bytes=True)).hexdigest()
+    assert hashdict(dict2, canonical=True) == expected
+    assert hashdict(OrderedDict(reversed(list(dict2.items()))), canonical=True) == expected
+    assert hashdict(dict2, canonical=True) != hashdict(dict2)
+    with pytest.raises(ValueError):
+        hashdict(dict2, canonical=True, streaming=True)
+
+
+@pytest.mark.parametrize('base_class', [dict, MerkleAutoDict, MerkleAutoOrderedDict])
+def test_merkle_hashdict(base_class, dict2):
+    d = base_class()
+    d['e'] = base_class()
+    d['e']['e2'] = 'test2'
+    d['e']['e3'] = base_class()
+    d['e']['e3']['e3a'] = 0
+    d['e']['e3']['e3b'] = [None]
+    d['x'] = 'xxx'
+    assert d == dict2
+    assert merkle_hashdict(d) == merkle_hashdict(dict2) == 'd60ba0ae31f28547df9a91b9535de8a2510c272f'
+    assert merkle_hashdict(d, method='md5') == merkle_hashdict(dict2, method='md5')
+    assert merkle_hashdict(d) != hashdict(d)
+    # a nested dict is not the same as its json representation
+    assert merkle_hashdict({'e': {'a': 1}}) != merkle_hashdict({'e': ['d', merkle_hashdict({'a': 1})]})
+    assert merkle_hashdict({}) != merkle_hashdict({'e': {}})
+
+
+@pytest.mark.parametrize('base_class', [MerkleAutoDict, MerkleAutoOrderedDict])
+def test_merkle_autodict_invalidation(base_class):
+    d = base_class()
+    d['a']['b']['c'] = 1
+    d['a']['d'] = [1, 2]
+    d['x']['y'] = 2
+
+    def check(expected_dict):
+        digest = merkle_hashdict(d)
+        assert digest == merkle_hashdict(expected_dict)
+        return digest
+
+    digest = check({'a': {'b': {'c': 1}, 'd': [1, 2]}, 'x': {'y': 2}})
+    assert d._merkle_digests['sha1'] == digest
+    assert d['x']._merkle_digests
+    d['a']['b']['c'] = 3
+    # only the digests along the modified path have been cleared
+    assert not d._merkle_digests
+    assert not d['a']._merkle_digests
+    assert not d['a']['b']._merkle_digests
+    assert d['x']._merkle_digests
+    check({'a': {'b': {'c': 3}, 'd': [1, 2]}, 'x': {'y': 2}})
+    del d['a']['b']['c']
+    check({'a': {'b': {}, 'd': [1, 2]}, 'x': {'y': 2}})
+    d['a']['b'].update({'c': 4}, e=5)
+    check({'a': {'b': {'c': 4, 'e': 5}, 'd': [1, 2]}, 'x': {'y': 2}})
+    d['a']['b'].pop('e')
+    check({'a': {'b': {'c': 4}, 'd': [1, 2]}, 'x': {'y': 2}})
+    d['a']['b'].popitem()
+    check({'a': {'b': {}, 'd': [1, 2]}, 'x': {'y': 2}})
+    d['x'].setdefault('z', 3)
+    check({'a': {'b': {}, 'd': [1, 2]}, 'x': {'y': 2, 'z': 3}})
+    d['x'] |= {'y': 0}
+    check({'a': {'b': {}, 'd': [1, 2]}, 'x': {'y': 0, 'z': 3}})
+    d['x'].clear()
+    check({'a': {'b': {}, 'd': [1, 2]}, 'x': {}})
+    d['a']['d'].append(3)
+    d['a'].invalidate_digest()
+    check({'a': {'b': {}, 'd': [1, 2, 3]}, 'x': {}})
+    # autovivification is a modification too
+    d['new']
+    check({'a': {'b': {}, 'd': [1, 2, 3]}, 'x': {}, 'new': {}})
+    # a node moved to another parent invalidates both
+    moved = d['a']['b']
+    d['m'] = moved
+    check({'a': {'b': {}, 'd': [1, 2, 3]}, 'x': {}, 'new': {}, 'm': {}})
+    moved['k'] = 1
+    check({'a': {'b': {'k': 1}, 'd': [1, 2, 3]}, 'x': {}, 'new': {}, 'm': {'k': 1}})
+
+
+def test_merkle_autodict_init_and_pickle():
+    import pickle
+    child = MerkleAutoDict(a=1)
+    d = MerkleAutoOrderedDict([('c', child), ('b', 2)])
+    digest = merkle_hashdict(d)
+    child['a'] = 2
+    assert merkle_hashdict(d) != digest
+    d2 = pickle.loads(pickle.dumps(d))
+    assert type(d2) is MerkleAutoOrderedDict
+    assert type(d2['c']) is MerkleAutoDict
+    assert d2 == d
+    assert merkle_hashdict(d2) == merkle_hashdict(d)
+    d2['c']['a'] = 1
+    assert merkle_hashdict(d2) == digest
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_hashdicts(dict1, dict2, dict3, workers):
+    dicts = [dict2, dict3, {}, {'a': [1, 2]}] * 10
+    expected = [hashdict(d, method='md5') for d in dicts]
+    res = hashdicts(iter(dicts), method='md5', workers=workers, chunksize=3)
+    assert list(res) == expected
+    assert list(hashdicts([], workers=workers)) == []
+    with pytest.raises(TypeError):
+        list(hashdicts([dict2, {'lambda': lambda x: x}], workers=1))
+    with pytest.raises(AssertionError):
+        list(hashdicts([dict2, [1, 2]], workers=workers))
+    with pytest.raises(ValueError):
+        list(hashdicts(dicts, workers=workers, chunksize=0))
 
 
 def test_autodict(base_class=AutoDict):
@@ -251,6 +575,324 @@ def test_autoordereddict():
     test_autodict(base_class=AutoOrderedDict)
 
 
+@pytest.mark.parametrize('base_class', [AutoDict, AutoOrderedDict])
+def test_autodict_to_dict_deep(base_class):
+    depth = sys.getrecursionlimit() * 2
+    adict = base_class()
+    node = adict
+    for i in range(depth):
+        node['leaf'] = i
+        node = node['x']
+    adict_as_dict = adict.to_dict()
+    node = adict_as_dict
+    for i in range(depth):
+        assert type(node) is base_class._base_class
+        assert node['leaf'] == i
+        node = node['x']
+    assert node == {}
+
+
+def test_autodict_to_dict_shares_leaves():
+    adict = AutoOrderedDict()
+    adict['a']['list'] = [1, 2]
+    adict['a']['dict'] = {'x': {'y': 1}}
+    adict['b'] = 2
+    adict['c']['d']['e'] = 3
+    adict_as_dict = adict.to_dict()
+    assert adict_as_dict == {'a': {'list': [1, 2], 'dict': {'x': {'y': 1}}}, 'b': 2, 'c': {'d': {'e': 3}}}
+    assert list(adict_as_dict.keys()) == ['a', 'b', 'c']
+    assert adict_as_dict['a']['list'] is adict['a']['list']
+    assert adict_as_dict['a']['dict'] is adict['a']['dict']
+    assert adict_as_dict['a'] is not adict['a']
+
+
+@pytest.mark.parametrize('base_class', [AutoDict, AutoOrderedDict])
+def test_autodict_set_get_path(base_class):
+    adict = base_class()
+    adict.set_path(('a', 'b', 'c'), 1)
+    adict.set_path(['a', 'd'], 2)
+    adict.set_path(('e',), 3)
+    assert adict == {'a': {'b': {'c': 1}, 'd': 2}, 'e': 3}
+    assert isinstance(adict['a']['b'], base_class)
+    assert adict.get_path(('a', 'b', 'c')) == 1
+    assert adict.get_path(['a', 'd']) == 2
+    assert adict.get_path(('a',)) == {'b': {'c': 1}, 'd': 2}
+    assert adict.get_path(()) is adict
+    assert adict.get_path(('a', 'x', 'y')) is None
+    assert adict.get_path(('a', 'd', 'y'), default='default') == 'default'
+    assert 'x' not in adict['a']
+    with pytest.raises(ValueError):
+        adict.set_path((), 4)
+    adict['f'] = {}
+    with pytest.raises(KeyError):
+        adict.set_path(('f', 'g', 'h'), 5)
+    with pytest.raises(TypeError):
+        adict.set_path(('e', 'g', 'h'), 5)
+
+
+@pytest.mark.parametrize('base_class', [AutoDict, AutoOrderedDict])
+def test_autodict_bulk_set(base_class):
+    items = [
+        (('a', 'b', 'c'), 1),
+        (('a', 'b', 'd'), 2),
+        (('a', 'e'), 3),
+        (('a', 'b', 'f'), 4),
+        (('g',), 5),
+        (('a', 'e'), {'x': 0}),
+        (('a', 'e', 'y'), 6),
+        (['h', 'i'], 7),
+    ]
+    adict = base_class()
+    adict.bulk_set(items)
+    expected = base_class()
+    for path, value in items:
+        node = expected
+        for key in path[:-1]:
+            node = node[key]
+        node[path[-1]] = value
+    assert adict == expected
+    assert adict.to_dict() == {
+        'a': {'b': {'c': 1, 'd': 2, 'f': 4}, 'e': {'x': 0, 'y': 6}},
+        'g': 5,
+        'h': {'i': 7},
+    }
+    with pytest.raises(ValueError):
+        adict.bulk_set([((), 4)])
+    with pytest.raises(TypeError):
+        adict.bulk_set([(('g', 'x'), 4)])
+
+
+def test_autodict_peek():
+    adict = AutoDict()
+    adict['a']['b']['c'] = 1
+    adict['d'] = {'e': 2}
+    peek = adict.peek()
+    assert isinstance(peek, AutoDictPeekView)
+    assert peek['a']['b']['c'] == 1
+    assert isinstance(peek['a']['b'], AutoDictPeekView)
+    assert peek['x'] is MISSING
+    assert peek['x']['y']['z'] is MISSING
+    assert peek['a']['x']['y'] is MISSING
+    assert peek['d']['e'] == 2
+    assert not peek['a']['x']
+    assert list(peek['x']) == []
+    for _ in peek['a']['x']:
+        pytest.fail('MISSING must be empty')
+    assert 'k' not in peek['x']
+    assert len(peek['x']) == 0
+    assert repr(MISSING) == 'MISSING'
+    assert peek.get('x') is None
+    assert peek['a'].get('b') == {'c': 1}
+    assert peek.get('x', 0) == 0
+    assert adict == {'a': {'b': {'c': 1}}, 'd': {'e': 2}}
+    with pytest.raises(KeyError):
+        peek['d']['x']
+
+
+@pytest.mark.parametrize('base_class', [AutoDict, AutoOrderedDict])
+def test_autodict_prune_empty(base_class):
+    adict = base_class()
+    adict['a']['b']['c'] = 1
+    adict['a']['x']['y']['z']
+    adict['a']['b']['w']
+    adict['e'] = {}
+    adict['f']
+    adict['g']['h'] = base_class()
+    assert adict.prune_empty() == 7
+    assert adict == {'a': {'b': {'c': 1}}, 'e': {}}
+    assert adict.prune_empty() == 0
+    adict['a']['b'].pop('c')
+    assert adict.prune_empty() == 2
+    assert adict == {'e': {}}
+
+
+def test_autodict_freeze():
+    adict = AutoDict()
+    adict['a']['b'] = 1
+    adict['c'] = {'d': 2}
+    view = adict.freeze()
+    assert isinstance(view, AutoDictView)
+    assert isinstance(view['a'], AutoDictView)
+    assert view['a']['b'] == 1
+    assert view['c'] == {'d': 2}
+    assert view.get('x') is None
+    with pytest.raises(KeyError):
+        view['a']['x']
+    with pytest.raises(TypeError):
+        view['y'] = 3
+    assert 'x' not in adict
+    assert 'x' not in adict['a']
+    assert len(view) == 2
+    assert sorted(view) == ['a', 'c']
+    assert view == {'a': {'b': 1}, 'c': {'d': 2}}
+    assert view.to_dict() == adict.to_dict()
+    adict['e'] = 5
+    assert view['e'] == 5
+    assert repr(view['a']) == "AutoDictView({'b': 1})"
+
+
+def test_flat_autodict():
+    d = FlatAutoDict()
+    d['a']['b']['c'] = 1
+    d['a']['b']['d'] = 2
+    d['a']['e'] = 3
+    d['f'] = 4
+    assert d['a']['b']['c'] == 1
+    assert d.get_path(['a', 'e']) == 3
+    assert d.get_path(['a', 'x']) is None
+    assert d.get_path(['a', 'b']) == {'c': 1, 'd': 2}
+    assert d.to_dict() == {'a': {'b': {'c': 1, 'd': 2}, 'e': 3}, 'f': 4}
+    assert d == {'a': {'b': {'c': 1, 'd': 2}, 'e': 3}, 'f': 4}
+    assert list(d) == ['a', 'f']
+    assert len(d) == 2 and len(d['a']) == 2
+    assert 'a' in d and 'b' in d['a'] and 'x' not in d['a']
+    # missing keys don't create empty branches
+    node = d['x']['y']
+    assert 'x' not in d
+    assert node.to_dict() == {}
+    node['z'] = 5
+    assert d['x'] == {'y': {'z': 5}}
+    assert list(d.items(prefix=['a'])) == [(('a', 'b', 'c'), 1), (('a', 'b', 'd'), 2), (('a', 'e'), 3)]
+    assert list(d['a'].items(prefix=['b'])) == [(('b', 'c'), 1), (('b', 'd'), 2)]
+    assert list(d.items(prefix=['f'])) == [(('f',), 4)]
+    assert list(d.items(prefix=['nope'])) == []
+    assert dict(d['a']['b'].items()) == {'c': 1, 'd': 2}
+    del d['a']['b']
+    assert d.to_dict() == {'a': {'e': 3}, 'f': 4, 'x': {'y': {'z': 5}}}
+    with pytest.raises(KeyError):
+        del d['a']['b']
+    d.set_path(['g', 'h'], 6)
+    assert d['g']['h'] == 6
+    with pytest.raises(ValueError):
+        d.set_path([], 0)
+
+
+def test_flat_autodict_get_pop_setdefault():
+    d = FlatAutoDict({'a': {'b': 1}, 'c': 2})
+    assert d.get('zz', 42) == 42
+    assert d.get('zz') is None
+    assert d.get('c', 42) == 2
+    assert d.get('a') == {'b': 1}
+    assert d.pop('zz', 42) == 42
+    with pytest.raises(KeyError):
+        d.pop('zz')
+    assert d.pop('c') == 2
+    assert d.pop('a') == {'b': 1}
+    assert d.to_dict() == {}
+    assert d.setdefault('k', 5) == 5
+    assert d.setdefault('k', 6) == 5
+    assert d.setdefault('n', {'x': 1}) == {'x': 1}
+    assert d.to_dict() == {'k': 5, 'n': {'x': 1}}
+
+
+def test_flat_autodict_replace():
+    d = FlatAutoDict({'a': {'b': {'c': 1}, 'd': 2}})
+    # a leaf replaces a subtree
+    d['a']['b'] = 3
+    assert d.to_dict() == {'a': {'b': 3, 'd': 2}}
+    # a subtree replaces a leaf, even through a node created before
+    node = d['a']['x']
+    d['a']['x'] = 4
+    node['y'] = 5
+    assert d.to_dict() == {'a': {'b': 3, 'd': 2, 'x': {'y': 5}}}
+    # mappings are flattened, empty mappings are dropped
+    d['a'] = {'b': {}, 'e': {'f': 6}}
+    assert d.to_dict() == {'a': {'e': {'f': 6}}}
+    d['z'] = d['a']
+    d['a']['e']['f'] = 7
+    assert d['z'] == {'e': {'f': 6}}
+    d.clear()
+    assert len(d) == 0 and d.to_dict() == {}
+
+
+def test_flat_autodict_conversions(dict2):
+    d = FlatAutoDict.from_dict(dict2)
+    assert d.to_dict() == dict2
+    autodict = AutoDict()
+    autodict['a']['b']['c'] = 1
+    autodict['a']['d'] = 2
+    d = FlatAutoDict.from_dict(autodict)
+    assert d.to_dict() == autodict.to_dict()
+    for cls in (AutoDict, AutoOrderedDict):
+        converted = d.to_autodict(cls)
+        assert type(converted) is cls and type(converted['a']) is cls
+        assert converted.to_dict() == autodict.to_dict()
+    import pickle
+    assert pickle.loads(pickle.dumps(d)).to_dict() == autodict.to_dict()
+
+
+def test_flat_autodict_unsortable_keys():
+    d = FlatAutoDict()
+    d['a'][1] = 1
+    d['a']['b'] = 2
+    d[3]['c'] = 3
+    assert list(d.items(prefix=['a'])) == [(('a', 1), 1), (('a', 'b'), 2)]
+    assert list(d) == ['a', 3]
+    assert d.to_dict() == {'a': {1: 1, 'b': 2}, 3: {'c': 3}}
+
+
+def test_flat_autodict_same_as_nested_dicts():
+    rng = random.Random(1)
+    d = FlatAutoDict()
+    ref = {}
+    for _ in range(3000):
+        path = tuple(rng.choice('abc') for _ in range(rng.randrange(1, 4)))
+        node = ref
+        if rng.random() < 0.3:
+            for key in path[:-1]:
+                node = node.get(key) if isinstance(node, dict) else None
+            if isinstance(node, dict) and path[-1] in node:
+                del node[path[-1]]
+                del d.get_path(path[:-1], d)[path[-1]]
+        else:
+            for key in path[:-1]:
+                if not isinstance(node.get(key), dict):
+                    node[key] = {}
+                node = node[key]
+            node[path[-1]] = rng.randrange(10)
+            d.set_path(path, node[path[-1]])
+        # branches emptied by the deletions are dropped by FlatAutoDict
+        stack = [ref]
+        while stack:
+            node = stack.pop()
+            for key, value in list(node.items()):
+                if isinstance(value, dict):
+                    if value:
+                        stack.append(value)
+                    else:
+                        del node[key]
+        if rng.random() < 0.1:
+            prefix = path[:rng.randrange(len(path))]
+            sub = d.get_path(prefix, {}) if prefix else d
+            expected = ref
+            for key in prefix:
+                expected = expected.get(key, {}) if isinstance(expected, dict) else {}
+            assert sub == expected
+            if isinstance(expected, dict):
+                assert len(sub) == len(expected)
+                assert set(sub) == set(expected)
+                assert all(key in sub for key in expected) and 'z' not in sub
+            assert [path for path, _ in d.items(prefix=prefix)] == sorted(path for path, _ in d.items(prefix=prefix))
+    assert d.to_dict() == ref
+    for key in list(d):
+        del d[key]
+    # the index doesn't keep the emptied nodes
+    assert len(d) == 0 and d._children == {(): {}} and d._sorted_paths == []
+
+
+def test_flat_autodict_iteration_order():
+    d = FlatAutoDict()
+    d['b']['y'] = 1
+    d['a'] = 2
+    d['b']['x'] = 3
+    d['c']['z'] = 4
+    assert list(d) == ['b', 'a', 'c']
+    assert list(d['b']) == ['y', 'x']
+    del d['a']
+    d['a']['w'] = 5
+    assert list(d) == ['b', 'c', 'a']
+
+
 def test_dict_values_map_1(dict3):
     res = dict_values_map(lambda x: x % 10, dict3)
     expected_res = {
@@ -272,3 +914,60 @@ def test_dict_values_map_1(dict3):
     }
     assert res == expected_res
     pass
+
+
+@pytest.fixture(scope='module')
+def records():
+    return [
+        {'id': 1, 'name': 'a', 'value': 1.5},
+        {'id': 2, 'value': 2.5, 'name': 'b'},
+        {'id': 3, 'name': 'c', 'value': -1.0},
+    ]
+
+
+def test_records_to_columns(records):
+    columns = records_to_columns(records)
+    assert columns == {'id': [1, 2, 3], 'name': ['a', 'b', 'c'], 'value': [1.5, 2.5, -1.0]}
+    assert list(columns) == ['id', 'name', 'value']
+    assert columns_to_records(columns) == records
+    assert records_to_columns([]) == {}
+    assert records_to_columns([{'a': 1}, {'a': 2}]) == {'a': [1, 2]}
+    assert records_to_columns([{}, {}]) == {}
+    assert columns_to_records({}) == []
+    with pytest.raises(ValueError):
+        records_to_columns([{'a': 1}, {'b': 2}])
+    with pytest.raises(ValueError):
+        records_to_columns([{'a': 1, 'b': 2}, {'a': 2, 'c': 3}])
+    with pytest.raises(ValueError):
+        records_to_columns([{'a': 1, 'b': 2}, {'a': 2}])
+    with pytest.raises(ValueError):
+        columns_to_records({'a': [1, 2], 'b': [1]})
+    assert columns_to_records({'a': (1, 2), 'b': range(2)}) == [{'a': 1, 'b': 0}, {'a': 2, 'b': 1}]
+
+
+def test_dict_values_map_batch(records):
+    res = dict_values_map_batch(str, records)
+    assert res == [dict_values_map(str, record) for record in records]
+    res = dict_values_map_batch({'value': abs, 'name': str.upper}, records)
+    assert res == [
+        {'id': 1, 'name': 'A', 'value': 1.5},
+        {'id': 2, 'name': 'B', 'value': 2.5},
+        {'id': 3, 'name': 'C', 'value': 1.0},
+    ]
+    res = dict_values_map_batch({'value': lambda column: [v - min(column) for v in column]}, records,
+                                vectorized=True, columnar=True)
+    assert res == {'id': [1, 2, 3], 'name': ['a', 'b', 'c'], 'value': [2.5, 3.5, 0.0]}
+    assert records[2]['value'] == -1.0
+    assert dict_values_map_batch(str, []) == []
+    assert dict_values_map_batch(str, [{}, {}]) == [{}, {}]
+    assert dict_values_map_batch(str, [{}, {}], columnar=True) == {}
+    for columnar in (False, True):
+        with pytest.raises(ValueError):
+            dict_values_map_batch({'value': lambda column: column[1:]}, records, vectorized=True, columnar=columnar)
+
+
+def test_dict_values_map_batch_numpy(records):
+    np = pytest.importorskip('numpy')
+    res = dict_values_map_batch({'value': lambda column: np.asarray(column) * 2}, records, vectorized=True)
+    assert res[0] == {'id': 1, 'name': 'a', 'value': 3.0}
+    assert type(res[0]['value']) is float
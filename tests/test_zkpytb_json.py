@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the `json` module of `zkpytb` package."""
+
+import datetime
+import decimal
+import io
+import json
+import pytest
+import random
+import struct
+import subprocess
+import sys
+import uuid
+from collections import OrderedDict
+from pathlib import Path, PurePosixPath
+
+
+from zkpytb.json import (
+    JSONEncoder,
+    JSONLinesWriter,
+    canonical_dumps,
+    dump,
+    dumps,
+    field_converters_hook,
+    iterencode_chunked,
+    read_json_lines,
+)
+
+
+@pytest.fixture(scope='module')
+def extended_types_dict():
+    return {
+        'path': Path('a/b'),
+        'uuid': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+        'datetime': datetime.datetime(2020, 1, 2, 3, 4, 5, 6),
+        'date': datetime.date(2020, 1, 2),
+        'time': datetime.time(3, 4, 5),
+        'timedelta': datetime.timedelta(days=1, seconds=1.5),
+        'complex': 1 + 2j,
+        'decimal': decimal.Decimal('1.10'),
+        'native': [1, 2.5, 'a', None, True],
+    }
+
+
+def test_json_encoder(extended_types_dict):
+    assert json.loads(json.dumps(extended_types_dict, cls=JSONEncoder)) == {
+        'path': 'a/b',
+        'uuid': '12345678-1234-5678-1234-567812345678',
+        'datetime': '2020-01-02T03:04:05.000006',
+        'date': '2020-01-02',
+        'time': '03:04:05',
+        'timedelta': 86401.5,
+        'complex': '(1+2j)',
+        'decimal': '1.10',
+        'native': [1, 2.5, 'a', None, True],
+    }
+
+
+def test_json_encoder_unsupported_type():
+    with pytest.raises(TypeError):
+        json.dumps({'a': object()}, cls=JSONEncoder)
+    # only concrete paths are supported
+    with pytest.raises(TypeError):
+        json.dumps(PurePosixPath('a'), cls=JSONEncoder)
+
+
+def test_json_encoder_subclass_of_supported_type():
+    class MyDatetime(datetime.datetime):
+        pass
+
+    assert json.dumps(MyDatetime(2020, 1, 2), cls=JSONEncoder) == '"2020-01-02T00:00:00"'
+
+
+def test_json_encoder_register():
+    class Point:
+        def __init__(self, x, y):
+            self.x, self.y = x, y
+
+    class Point3D(Point):
+        pass
+
+    class ParentJSONEncoder(JSONEncoder):
+        pass
+
+    class MyJSONEncoder(ParentJSONEncoder):
+        pass
+
+    # resolve and cache the types before registering
+    for encoder in (JSONEncoder, ParentJSONEncoder, MyJSONEncoder):
+        with pytest.raises(TypeError):
+            json.dumps(Point(1, 2), cls=encoder)
+
+    MyJSONEncoder.register(Point, lambda p: [p.x, p.y])
+    assert json.dumps([Point(1, 2), Point3D(3, 4)], cls=MyJSONEncoder) == '[[1, 2], [3, 4]]'
+    assert json.dumps(Path('a'), cls=MyJSONEncoder) == '"a"'
+    with pytest.raises(TypeError):
+        json.dumps(Point(1, 2), cls=ParentJSONEncoder)
+
+    # the most specific type wins, and registering on the parent is seen by the subclass
+    ParentJSONEncoder.register(Point3D, lambda p: {'x': p.x, 'y': p.y})
+    assert json.dumps([Point(1, 2), Point3D(3, 4)], cls=MyJSONEncoder) == '[[1, 2], {"x": 3, "y": 4}]'
+    assert json.dumps(Point3D(3, 4), cls=ParentJSONEncoder) == '{"x": 3, "y": 4}'
+    with pytest.raises(TypeError):
+        json.dumps(Point3D(3, 4), cls=JSONEncoder)
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_json_lines_roundtrip(tmp_path, extended_types_dict, compression, use_mmap):
+    if use_mmap and compression:
+        pytest.skip('mmap is only supported for uncompressed files')
+    records = [dict(extended_types_dict, i=i, text='line\nbreak') for i in range(25)]
+    path = tmp_path / 'records.jsonl'
+    with JSONLinesWriter(path, compression=compression, batch_size=10) as writer:
+        writer.write(records[0])
+        writer.write_many(records[1:])
+        assert writer.num_records == 20
+    assert writer.num_records == 25
+    if compression is None:
+        assert path.read_bytes().count(b'\n') == 25
+    hook = field_converters_hook({
+        'datetime': datetime.datetime.fromisoformat,
+        'uuid': uuid.UUID,
+        'path': Path,
+        'decimal': decimal.Decimal,
+    })
+    records_read = list(read_json_lines(path, compression=compression, use_mmap=use_mmap, object_hook=hook))
+    assert len(records_read) == 25
+    for record, record_read in zip(records, records_read):
+        for key in ('i', 'text', 'datetime', 'uuid', 'path', 'decimal', 'native'):
+            assert record_read[key] == record[key]
+        assert record_read['date'] == '2020-01-02'
+
+
+def test_json_lines_file_objects():
+    buffer = io.BytesIO()
+    with JSONLinesWriter(buffer, sort_keys=True) as writer:
+        writer.write_many([{'b': 1, 'a': 2}, [1, 2], 'x'])
+    assert not buffer.closed
+    assert buffer.getvalue() == b'{"a": 2, "b": 1}\n[1, 2]\n"x"\n'
+    buffer = io.BytesIO(b'{"a": 1}\n\n  \n{"a": 2.5}')
+    assert list(read_json_lines(buffer, parse_float=decimal.Decimal)) == [{'a': 1}, {'a': decimal.Decimal('2.5')}]
+    assert not buffer.closed
+
+
+def test_json_lines_errors(tmp_path):
+    with pytest.raises(ValueError):
+        JSONLinesWriter(io.BytesIO(), indent=2)
+    with pytest.raises(ValueError):
+        JSONLinesWriter(io.BytesIO(), compression='rar')
+    with pytest.raises(ValueError):
+        list(read_json_lines(io.BytesIO(), use_mmap=True))
+    path = tmp_path / 'empty.jsonl'
+    path.write_bytes(b'')
+    assert list(read_json_lines(path, use_mmap=True)) == []
+    assert list(read_json_lines(str(path))) == []
+
+
+def random_json_document(rnd, depth=0):
+    kind = rnd.randrange(16 if depth < 4 else 14)
+    if kind == 0:
+        return rnd.randint(-2**70, 2**70) if rnd.random() < 0.05 else rnd.randint(-10**6, 10**6)
+    if kind == 1:
+        return rnd.uniform(-1, 1) * 10 ** rnd.randint(-25, 25)
+    if kind == 2:
+        return rnd.choice([0.0, -0.0, 1e-5, 1.5e-4, 1e16, 5e-324, float('nan'), float('inf'), -float('inf')])
+    if kind == 3:
+        return ''.join(rnd.choice('ab é\u20ac\U0001f600\x00\x1f\x7f"\\/\n\u2028') for _ in range(rnd.randrange(8)))
+    if kind == 4:
+        return rnd.choice([None, True, False, 'null', 'x1e5', 'a0.00001'])
+    if kind == 5:
+        return datetime.datetime(2020, 1, 2, 3, 4, 5, rnd.choice([0, 6])) + datetime.timedelta(days=rnd.randrange(1000))
+    if kind == 6:
+        return rnd.choice([datetime.date(2020, 1, 2), datetime.time(3, 4, 5, 6)])
+    if kind == 7:
+        return uuid.UUID(int=rnd.getrandbits(128))
+    if kind == 8:
+        return rnd.choice([Path('a/b'), decimal.Decimal('1.10'), 1 + 2j])
+    if kind == 9:
+        return datetime.timedelta(seconds=rnd.uniform(-1e6, 1e6))
+    if kind < 12:
+        return [random_json_document(rnd, depth + 1) for _ in range(rnd.randrange(5))]
+    if kind == 12 and rnd.random() < 0.1:
+        return {rnd.choice([1, 2.5, None, True]): random_json_document(rnd, depth + 1)}
+    keys = ['k{}'.format(rnd.randrange(100)) for _ in range(rnd.randrange(6))] + rnd.sample(['é', 'Z', 'a', ''], 2)
+    return {key: random_json_document(rnd, depth + 1) for key in keys}
+
+
+@pytest.mark.parametrize('sort_keys', [False, True])
+@pytest.mark.parametrize('backend', [None, 'stdlib', 'orjson'])
+def test_dumps_same_as_stdlib(backend, sort_keys):
+    if backend == 'orjson':
+        pytest.importorskip('orjson')
+    rnd = random.Random(0)
+    for _ in range(500):
+        doc = random_json_document(rnd)
+        expected = json.dumps(doc, cls=JSONEncoder, separators=(',', ':'), ensure_ascii=False, sort_keys=sort_keys)
+        assert dumps(doc, sort_keys=sort_keys, backend=backend) == expected
+
+
+def test_dumps_orjson_null_without_non_finite_floats(monkeypatch):
+    pytest.importorskip('orjson')
+    import zkpytb.json
+    assert dumps([None, 1.5, {'a': float('nan')}], backend='orjson') == '[null,1.5,{"a":NaN}]'
+    assert dumps({'a': Path('x'), 'b': [float('inf')]}, backend='orjson') == '{"a":"x","b":[Infinity]}'
+
+    def fail(obj):
+        raise AssertionError('the stdlib encoder should not be used')
+
+    # documents with null but without NaN or infinities don't fall back to the stdlib encoder
+    monkeypatch.setattr(zkpytb.json._compact_encoders[False], 'encode', fail)
+    assert dumps([None, 1.5, {'a': None, 'b': Path('x')}, 'null'], backend='orjson') == \
+        '[null,1.5,{"a":null,"b":"x"},"null"]'
+
+
+@pytest.mark.parametrize('backend', [None, 'stdlib', 'orjson'])
+def test_dumps_errors(backend):
+    if backend == 'orjson':
+        pytest.importorskip('orjson')
+    circular = []
+    circular.append(circular)
+    with pytest.raises(ValueError):
+        dumps(circular, backend=backend)
+    with pytest.raises(TypeError):
+        dumps({'a': object()}, backend=backend)
+    with pytest.raises(TypeError):
+        dumps(b'bytes', backend=backend)
+    with pytest.raises(TypeError):
+        dumps({1: 1, 'a': 2}, sort_keys=True, backend=backend)
+    with pytest.raises(ValueError):
+        dumps(1, backend='ujson')
+
+
+def test_dump():
+    fp = io.StringIO()
+    dump({'b': [1, 2.5], 'a': Path('x')}, fp, sort_keys=True)
+    assert fp.getvalue() == '{"a":"x","b":[1,2.5]}'
+
+
+def test_dumps_registered_uuid_converter():
+    value = [uuid.UUID(int=1)]
+    assert dumps(value) == '["00000000-0000-0000-0000-000000000001"]'
+    JSONEncoder.register(uuid.UUID, lambda u: u.int)
+    try:
+        assert dumps(value) == '[1]'
+    finally:
+        JSONEncoder.register(uuid.UUID, str)
+    assert dumps(value) == '["00000000-0000-0000-0000-000000000001"]'
+
+
+def test_import_does_not_import_numpy():
+    code = 'import sys, zkpytb.json; assert "numpy" not in sys.modules and "pandas" not in sys.modules'
+    subprocess.check_call([sys.executable, '-c', code])
+
+
+def test_iterencode_chunked_other_objects(extended_types_dict):
+    assert ''.join(iterencode_chunked(extended_types_dict)) == json.dumps(extended_types_dict, cls=JSONEncoder)
+    with pytest.raises(ValueError):
+        list(iterencode_chunked([], orient='index'))
+    with pytest.raises(ValueError):
+        list(iterencode_chunked([], encoder=JSONEncoder(indent=2)))
+
+
+def test_json_encoder_numpy():
+    np = pytest.importorskip('numpy')
+    doc = {
+        'int': np.int64(3),
+        'float32': np.float32(0.5),
+        'bool': np.bool_(True),
+        'array': np.arange(6).reshape(2, 3),
+        'floats': np.array([1.5, np.nan, np.inf]),
+        'datetime': np.datetime64('2020-01-02T03:04:05.123456789'),
+        'datetimes': np.array(['2020-01-02', 'NaT'], dtype='datetime64[D]'),
+        'timedelta': np.timedelta64(1500, 'ms'),
+    }
+    assert json.dumps(doc, cls=JSONEncoder) == (
+        '{"int": 3, "float32": 0.5, "bool": true, "array": [[0, 1, 2], [3, 4, 5]], "floats": [1.5, NaN, Infinity], '
+        '"datetime": "2020-01-02T03:04:05.123456", "datetimes": ["2020-01-02T00:00:00", null], "timedelta": 1.5}'
+    )
+    with pytest.raises(ValueError):
+        json.dumps(np.array([np.nan]), cls=JSONEncoder, allow_nan=False)
+    array = np.linspace(0, 1, 25).reshape(5, 5)
+    for chunk_size in (1, 2, 10):
+        assert ''.join(iterencode_chunked(array, chunk_size=chunk_size)) == json.dumps(array.tolist())
+    assert ''.join(iterencode_chunked(np.array([]))) == '[]'
+
+
+def test_json_encoder_pandas():
+    pd = pytest.importorskip('pandas')
+    np = pytest.importorskip('numpy')
+    df = pd.DataFrame({
+        'a': [1, 2, 3],
+        'b': [0.5, np.nan, 1.5],
+        'c': pd.to_datetime(['2020-01-02 00:00:00', None, '2020-01-03 04:05:06']),
+        'd': pd.array([1, None, 3], dtype='Int64'),
+        'e': ['x', 'y', None],
+    }, index=[10, 20, 30])
+    expected_records = [
+        {'a': 1, 'b': 0.5, 'c': '2020-01-02T00:00:00', 'd': 1, 'e': 'x'},
+        {'a': 2, 'b': float('nan'), 'c': None, 'd': None, 'e': 'y'},
+        {'a': 3, 'b': 1.5, 'c': '2020-01-03T04:05:06', 'd': 3, 'e': None},
+    ]
+    expected_columns = {key: [record[key] for record in expected_records] for key in 'abcde'}
+    assert json.dumps(df, cls=JSONEncoder) == json.dumps(expected_records)
+    assert json.dumps(df['b'], cls=JSONEncoder) == json.dumps(expected_columns['b'])
+    assert json.dumps(df.index, cls=JSONEncoder) == '[10, 20, 30]'
+    scalars = [pd.NaT, pd.NA, pd.Timestamp('2020-01-02')]
+    assert json.dumps(scalars, cls=JSONEncoder) == '[null, null, "2020-01-02T00:00:00"]'
+    for chunk_size in (1, 2, 10):
+        assert ''.join(iterencode_chunked(df, chunk_size=chunk_size)) == json.dumps(expected_records)
+        assert ''.join(iterencode_chunked(df, chunk_size=chunk_size, orient='columns')) == json.dumps(expected_columns)
+        assert ''.join(iterencode_chunked(df['a'], chunk_size=chunk_size)) == '[1, 2, 3]'
+    assert ''.join(iterencode_chunked(df.iloc[:0])) == '[]'
+    buffer = io.BytesIO()
+    with JSONLinesWriter(buffer) as writer:
+        writer.write_frame(df, chunk_size=2)
+    assert buffer.getvalue().decode('utf-8').splitlines() == [json.dumps(record) for record in expected_records]
+    # the missing values of the columns which aren't floats are null, whatever their dtype
+    for dtype in (object, 'string', str):
+        strings = pd.Series(['x', None, np.nan], dtype=dtype)
+        assert json.dumps(strings, cls=JSONEncoder) == '["x", null, null]'
+        assert ''.join(iterencode_chunked(strings, chunk_size=2)) == '["x", null, null]'
+        assert json.dumps(pd.Index(strings), cls=JSONEncoder) == '["x", null, null]'
+        assert json.dumps(pd.DataFrame({'s': strings}), cls=JSONEncoder) == '[{"s": "x"}, {"s": null}, {"s": null}]'
+
+
+@pytest.mark.parametrize('ieee_hex,expected', [
+    ('0000000000000000', '0'),
+    ('8000000000000000', '0'),
+    ('0000000000000001', '5e-324'),
+    ('8000000000000001', '-5e-324'),
+    ('7fefffffffffffff', '1.7976931348623157e+308'),
+    ('ffefffffffffffff', '-1.7976931348623157e+308'),
+    ('4340000000000000', '9007199254740992'),
+    ('c340000000000000', '-9007199254740992'),
+    ('4430000000000000', '295147905179352830000'),
+    ('44b52d02c7e14af5', '9.999999999999997e+22'),
+    ('44b52d02c7e14af6', '1e+23'),
+    ('44b52d02c7e14af7', '1.0000000000000001e+23'),
+    ('444b1ae4d6e2ef4e', '999999999999999700000'),
+    ('444b1ae4d6e2ef4f', '999999999999999900000'),
+    ('444b1ae4d6e2ef50', '1e+21'),
+    ('3eb0c6f7a0b5ed8c', '9.999999999999997e-7'),
+    ('3eb0c6f7a0b5ed8d', '0.000001'),
+    ('41b3de4355555553', '333333333.3333332'),
+    ('41b3de4355555554', '333333333.33333325'),
+    ('41b3de4355555555', '333333333.3333333'),
+    ('41b3de4355555556', '333333333.3333334'),
+    ('41b3de4355555557', '333333333.33333343'),
+    ('becbf647612f3696', '-0.0000033333333333333333'),
+    ('43143ff3c1cb0959', '1424953923781206.2'),
+])
+def test_canonical_dumps_floats(ieee_hex, expected):
+    # test vectors from RFC 8785 appendix B
+    value = struct.unpack('>d', bytes.fromhex(ieee_hex))[0]
+    assert canonical_dumps(value) == expected
+
+
+def test_canonical_dumps():
+    doc = {
+        'numbers': [333333333.33333329, 1E30, 4.50, 2e-3, 0.000000000000000000000000001],
+        'string': '€$\u000F\u000aA\'B"\\\\"/',
+        'literals': [None, True, False],
+    }
+    expected = '{"literals":[null,true,false],"numbers":[333333333.3333333,1e+30,4.5,0.002,1e-27],' \
+               '"string":"€$\\u000f\\nA\'B\\"\\\\\\\\\\"/"}'
+    assert canonical_dumps(doc) == expected
+    assert canonical_dumps(doc, as_bytes=True) == expected.encode('utf-8')
+    # keys are sorted by UTF-16 code units
+    doc = {'€': 0, '\r': 1, 'דּ': 2, '1': 3, '\U0001f600': 4, '\u0080': 5, 'ö': 6}
+    assert list(json.loads(canonical_dumps(doc))) == ['\r', '1', '\u0080', 'ö', '€', '\U0001f600', 'דּ']
+    assert canonical_dumps([2 ** 64, -1, 1.0, -0.0, 'é \x7f']) == '[18446744073709551616,-1,1,0,"é \x7f"]'
+
+
+def test_canonical_dumps_keys_and_types(extended_types_dict):
+    assert canonical_dumps({1: 'a', 'b': 2, None: 3, False: 4, 2.5: 5}) == '{"1":"a","2.5":5,"b":2,"false":4,"null":3}'
+    with pytest.raises(ValueError):
+        canonical_dumps({1: 'a', '1': 'b'})
+    with pytest.raises(TypeError):
+        canonical_dumps({(1, 2): 'a'})
+    # non-str keys are detected even after non-ASCII keys
+    assert canonical_dumps({'é': 1, 1: 2}) == '{"1":2,"é":1}'
+    assert canonical_dumps({'é': 1, 'a': 2}) == '{"a":2,"é":1}'
+    ordered = OrderedDict([('a', 1), ('b', OrderedDict([('d', 1), ('c', 2)]))])
+    assert canonical_dumps(ordered) == canonical_dumps(dict(ordered)) == '{"a":1,"b":{"c":2,"d":1}}'
+    expected = json.loads(json.dumps(extended_types_dict, cls=JSONEncoder))
+    assert json.loads(canonical_dumps(extended_types_dict)) == expected
+    assert canonical_dumps({'t': datetime.timedelta(seconds=2)}) == '{"t":2}'
+
+
+def test_canonical_dumps_errors():
+    for value in (float('nan'), float('inf'), -float('inf')):
+        with pytest.raises(ValueError):
+            canonical_dumps([value])
+    circular = {}
+    circular['a'] = [circular]
+    with pytest.raises(ValueError):
+        canonical_dumps(circular)
+    with pytest.raises(TypeError):
+        canonical_dumps(object())
+    with pytest.raises(ValueError):
+        canonical_dumps('\ud800', as_bytes=True)
+
+
+def test_canonical_dumps_deep_nesting():
+    depth = sys.getrecursionlimit() * 2
+    nested = []
+    for _ in range(depth):
+        nested = [{'a': nested, 'b': 1}]
+    assert canonical_dumps(nested) == '[{"a":' * depth + '[]' + ',"b":1}]' * depth
+    shared = [1]
+    assert canonical_dumps({'x': shared, 'y': [shared, shared]}) == '{"x":[1],"y":[[1],[1]]}'
@@ -5,9 +5,20 @@
 
 import pytest
 
+import asyncio
+import random
+import threading
+
 from zkpytb.priorityqueue import (
+    AsyncPriorityQueue,
+    BucketPriorityQueue,
+    ConcurrentPriorityQueue,
     EmptyQueueError,
+    IndexedPriorityQueue,
+    InstrumentedPriorityQueue,
+    PersistentPriorityQueue,
     PriorityQueue,
+    ShardedPriorityQueue,
 )
 
 
@@ -70,3 +81,570 @@ def test_priority_queue_iter():
     for task in pq:
         assert task == expected_tasks[i]
         i += 1
+
+
+def test_priority_queue_compact():
+    pq = PriorityQueue()
+    for i in range(100):
+        pq.add_task(i, i)
+    for i in range(40):
+        pq.remove_task(i)
+    # below the threshold: removed entries are left in the heap
+    assert len(pq) == 60
+    assert pq.num_removed == 40
+    assert len(pq.pq) == 100
+    for i in range(40, 51):
+        pq.remove_task(i)
+    # 51 removed entries out of 100: the heap has been compacted
+    assert len(pq) == 49
+    assert pq.num_removed == 0
+    assert len(pq.pq) == 49
+    assert list(pq) == list(range(51, 100))
+    assert pq.num_removed == 0
+    assert pq.pq == []
+
+
+def test_priority_queue_compact_on_update():
+    pq = PriorityQueue()
+    for i in range(100):
+        pq.add_task(i, i)
+    for _ in range(5):
+        for i in range(100):
+            pq.add_task(i, 100 - i)
+    assert len(pq) == 100
+    assert len(pq.pq) == 100 + pq.num_removed
+    assert len(pq.pq) <= 200
+    assert list(pq) == list(range(99, -1, -1))
+
+
+def test_priority_queue_compact_disabled():
+    pq = PriorityQueue(compact_threshold=None)
+    for i in range(100):
+        pq.add_task(i, i)
+    for i in range(90):
+        pq.remove_task(i)
+    assert pq.num_removed == 90
+    assert len(pq.pq) == 100
+    assert pq.pop_task() == 90
+    assert pq.num_removed == 0
+    pq.compact()
+    assert len(pq.pq) == len(pq) == 9
+
+
+def test_priority_queue_add_tasks():
+    pq = PriorityQueue()
+    pq.add_task('existing', 50)
+    pq.add_task('updated', 50)
+    pq.add_tasks([
+        ('c', 3),
+        ('a', 1),
+        ('updated', 2),
+        ('dup', 99),
+        ('b', 2),
+        ('dup', 0),
+    ])
+    assert len(pq) == 6
+    assert pq.entry_finder['updated'][0] == 2
+    assert pq.entry_finder['dup'][0] == 0
+    assert list(pq) == ['dup', 'a', 'updated', 'b', 'c', 'existing']
+    assert pq.num_removed == 0
+
+
+def test_priority_queue_add_tasks_small_batch():
+    pq = PriorityQueue()
+    pq.add_tasks((i, i) for i in range(0, 200, 2))
+    pq.add_tasks([(1, 1), (51, 51)])
+    assert len(pq) == 102
+    assert pq.pop_many(4) == [0, 1, 2, 4]
+
+
+def test_priority_queue_pop_many():
+    pq = PriorityQueue()
+    pq.add_tasks((str(i), i) for i in range(10))
+    pq.remove_task('1')
+    assert pq.pop_many(3) == ['0', '2', '3']
+    assert pq.pop_many(0) == []
+    assert pq.pop_many(100) == ['4', '5', '6', '7', '8', '9']
+    assert pq.pop_many(1) == []
+    assert pq.empty
+
+
+def test_priority_queue_pop_until():
+    pq = PriorityQueue()
+    pq.add_tasks([('a', 1), ('b', 2), ('b2', 2), ('c', 3), ('to be removed', 0)])
+    pq.remove_task('to be removed')
+    assert pq.pop_until(-1) == []
+    assert pq.pop_until(2) == ['a', 'b', 'b2']
+    assert len(pq) == 1
+    assert pq.pop_until(10) == ['c']
+    assert pq.pop_until(10) == []
+    assert pq.num_removed == 0
+
+
+@pytest.fixture(params=[PriorityQueue, IndexedPriorityQueue])
+def pq_class(request):
+    return request.param
+
+
+def test_priority_queue_peek_contains(pq_class):
+    pq = pq_class()
+    with pytest.raises(EmptyQueueError) as excinfo:
+        pq.peek()
+    assert excinfo.value.args[0] == 'peek from an empty priority queue'
+    pq.add_task('a', 2)
+    pq.add_task('b', 1)
+    pq.add_task('c', 3)
+    assert 'a' in pq
+    assert 'x' not in pq
+    assert pq.peek() == 'b'
+    assert pq.priority_of('c') == 3
+    pq.remove_task('b')
+    assert 'b' not in pq
+    assert pq.peek() == 'a'
+    assert len(pq) == 2
+    with pytest.raises(KeyError):
+        pq.priority_of('b')
+
+
+def test_indexed_priority_queue_update_in_place():
+    pq = IndexedPriorityQueue()
+    for i in range(100):
+        pq.add_task(i, i)
+    for i in range(100):
+        pq.add_task(i, 100 - i)
+    pq.add_task(50, -1)
+    pq.add_task(0, 1000)
+    pq.remove_task(10)
+    assert len(pq) == len(pq.pq) == 99
+    assert all(entry[3] == pos for pos, entry in enumerate(pq.pq))
+    assert pq.pop_task() == 50
+    assert pq.pop_task() == 99
+    assert list(pq)[-1] == 0
+
+
+def test_indexed_priority_queue_same_order_as_priority_queue():
+    rng = random.Random(42)
+    pq1 = PriorityQueue()
+    pq2 = IndexedPriorityQueue()
+    pq2.add_tasks((i, i % 7) for i in range(20))
+    pq1.add_tasks((i, i % 7) for i in range(20))
+    popped1 = []
+    popped2 = []
+    for _ in range(2000):
+        op = rng.random()
+        task = rng.randrange(200)
+        if op < 0.6:
+            priority = rng.randrange(20)
+            pq1.add_task(task, priority)
+            pq2.add_task(task, priority)
+        elif op < 0.8:
+            if task in pq1:
+                pq1.remove_task(task)
+                pq2.remove_task(task)
+        elif not pq1.empty:
+            popped1.append(pq1.pop_task())
+            popped2.append(pq2.pop_task())
+        assert len(pq1) == len(pq2) == len(pq2.pq)
+    assert popped1 == popped2
+    assert list(pq1) == list(pq2)
+
+
+def test_concurrent_priority_queue_pop_timeout():
+    pq = ConcurrentPriorityQueue()
+    with pytest.raises(EmptyQueueError):
+        pq.pop_task(timeout=0.01)
+    with pytest.raises(EmptyQueueError):
+        pq.pop_task(block=False)
+    pq.add_task('a', 2)
+    pq.add_task('b', 1)
+    pq.add_task('a', 0)
+    assert pq.pop_task(timeout=0.01) == 'a'
+    assert list(pq) == ['b']
+
+
+def test_concurrent_priority_queue_threads():
+    pq = ConcurrentPriorityQueue()
+    results = []
+    results_lock = threading.Lock()
+
+    def consumer():
+        while True:
+            task = pq.pop_task(timeout=5)
+            if isinstance(task, tuple):
+                break
+            with results_lock:
+                results.append(task)
+
+    def producer(start):
+        for i in range(start, start + 500):
+            pq.add_task(i, i)
+
+    consumers = [threading.Thread(target=consumer) for _ in range(4)]
+    producers = [threading.Thread(target=producer, args=(i * 500,)) for i in range(4)]
+    for t in consumers + producers:
+        t.start()
+    for t in producers:
+        t.join()
+    pq.add_tasks((('stop', i), float('inf')) for i in range(4))
+    for t in consumers:
+        t.join()
+    assert sorted(results) == list(range(2000))
+    assert pq.empty
+
+
+def test_async_priority_queue():
+
+    async def main():
+        pq = AsyncPriorityQueue()
+        with pytest.raises(EmptyQueueError):
+            await pq.pop_task(timeout=0.01)
+        with pytest.raises(EmptyQueueError):
+            pq.pop_task_nowait()
+
+        async def consumer():
+            return [await pq.pop_task() for _ in range(3)]
+
+        consumer_task = asyncio.ensure_future(consumer())
+        await asyncio.sleep(0)
+        pq.add_task('c', 3)
+        await asyncio.sleep(0)
+        pq.add_tasks([('b', 2), ('a', 1)])
+        assert await consumer_task == ['c', 'a', 'b']
+
+        waiters = [asyncio.ensure_future(pq.pop_task()) for _ in range(3)]
+        await asyncio.sleep(0)
+        waiters[0].cancel()
+        pq.add_tasks([('x', 1), ('y', 2)])
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        assert isinstance(results[0], asyncio.CancelledError)
+        assert results[1:] == ['x', 'y']
+
+        pq.add_task('z', 0)
+        assert list(pq) == ['z']
+
+    asyncio.run(main())
+
+
+def test_priority_queue_readd_removed_task():
+    pq = PriorityQueue()
+    pq.add_task('a', 1)
+    pq.add_task('b', 2)
+    pq.remove_task('a')
+    pq.add_task('a', 3)
+    assert pq.entry_finder['a'] == (3, 2, 'a')
+    assert len(pq.pq) == 3
+    # the removed entry of 'a' comes out of the heap first and must not drop the live one
+    assert pq.pop_task() == 'b'
+    assert pq.num_removed == 0
+    assert pq.entry_finder['a'] == (3, 2, 'a')
+    assert pq.pop_task() == 'a'
+    assert pq.empty
+
+
+def test_priority_queue_maxsize_invalid():
+    with pytest.raises(ValueError):
+        PriorityQueue(maxsize=0)
+    with pytest.raises(ValueError):
+        PriorityQueue(maxsize=3, evict='middle')
+
+
+@pytest.mark.parametrize('evict', ['largest', 'smallest'])
+def test_priority_queue_maxsize_top_k(evict):
+    rng = random.Random(0)
+    priorities = [rng.randrange(10000) for _ in range(5000)]
+    evicted = []
+    pq = PriorityQueue(maxsize=10, evict=evict, on_evict=lambda task, priority: evicted.append((task, priority)))
+    returned = [pq.add_task(i, prio) for i, prio in enumerate(priorities)]
+    assert len(pq) == 10
+    assert len(evicted) == 5000 - 10
+    assert sorted(task for task, _ in evicted) == sorted(task for task in returned if task is not None)
+    assert len(pq.pq) <= 2 * 10 + pq.compact_min_size
+    assert len(pq.worst_pq) <= 2 * 10 + pq.compact_min_size
+    kept = sorted(range(5000), key=lambda i: (priorities[i], i))
+    if evict == 'largest':
+        kept = kept[:10]
+    else:
+        kept = kept[-10:]
+    assert list(pq) == kept
+
+
+def test_priority_queue_maxsize_evict_largest():
+    evicted = []
+    pq = PriorityQueue(maxsize=3, on_evict=lambda task, priority: evicted.append((task, priority)))
+    assert pq.add_task('a', 1) is None
+    assert pq.add_task('b', 5) is None
+    assert pq.add_task('c', 3) is None
+    # rejected: not better than the current worst task
+    assert pq.add_task('d', 5) == 'd'
+    assert pq.add_task('e', 7) == 'e'
+    # evicts 'b'
+    assert pq.add_task('f', 2) == 'b'
+    # updating an existing task never evicts anything
+    assert pq.add_task('c', 0) is None
+    pq.remove_task('a')
+    assert pq.add_task('g', 10) is None
+    assert evicted == [('d', 5), ('e', 7), ('b', 5)]
+    assert list(pq) == ['c', 'f', 'g']
+
+
+def test_priority_queue_maxsize_evict_smallest():
+    pq = PriorityQueue(maxsize=2, evict='smallest')
+    pq.add_tasks([('a', 1), ('b', 5), ('c', 3), ('d', 0)])
+    assert len(pq) == 2
+    assert pq.add_task('e', 4) == 'c'
+    assert list(pq) == ['e', 'b']
+
+
+def test_bucket_priority_queue():
+    pq = BucketPriorityQueue(num_levels=16)
+    with pytest.raises(ValueError):
+        pq.add_task('x', 16)
+    with pytest.raises(ValueError):
+        pq.add_task('x', -1)
+    with pytest.raises(TypeError):
+        pq.add_task('x', 1.5)
+    assert 'x' not in pq
+    assert len(pq) == 0
+    pq.add_tasks([('a', 3), ('b', 0), ('c', 3), ('d', 15), ('e', 3)])
+    pq.add_task('b', 3)
+    pq.remove_task('c')
+    assert len(pq) == 4
+    assert 'c' not in pq
+    assert pq.priority_of('e') == 3
+    assert pq.peek() == 'a'
+    assert pq.pop_until(3) == ['a', 'e', 'b']
+    assert pq.pop_task() == 'd'
+    assert pq.empty
+    assert pq.nonempty == 0
+    assert pq.num_removed == 0
+    with pytest.raises(EmptyQueueError):
+        pq.pop_task()
+
+
+def test_bucket_priority_queue_compact():
+    pq = BucketPriorityQueue()
+    pq.add_tasks((i, i % 4) for i in range(100))
+    for i in range(60):
+        pq.remove_task(i)
+    # compacted after 51 removals, then 9 more removals
+    assert pq.num_removed == 9
+    assert sum(len(bucket) for bucket in pq.buckets) == 49
+    pq.remove_task(60)
+    pq.compact()
+    assert pq.num_removed == 0
+    assert sum(len(bucket) for bucket in pq.buckets) == 39
+
+
+def test_bucket_priority_queue_same_order_as_priority_queue():
+    rng = random.Random(1)
+    pq1 = PriorityQueue()
+    pq2 = BucketPriorityQueue(num_levels=8)
+    popped1 = []
+    popped2 = []
+    for _ in range(3000):
+        op = rng.random()
+        task = rng.randrange(100)
+        if op < 0.5:
+            priority = rng.randrange(8)
+            pq1.add_task(task, priority)
+            pq2.add_task(task, priority)
+        elif op < 0.7:
+            if task in pq1:
+                pq1.remove_task(task)
+                pq2.remove_task(task)
+        else:
+            popped1.extend(pq1.pop_many(2))
+            popped2.extend(pq2.pop_many(2))
+        assert len(pq1) == len(pq2)
+    assert popped1 == popped2
+    assert list(pq1) == list(pq2)
+
+
+def test_persistent_priority_queue_reopen(tmp_path):
+    path = tmp_path / 'queue.log'
+    pq = PersistentPriorityQueue(path)
+    pq.add_tasks([('a', 3), ('b', 1), ('c', 2), ('d', 2)])
+    pq.add_task('e', 0)
+    pq.add_task('a', 1)
+    pq.remove_task('c')
+    assert pq.pop_task() == 'e'
+    # simulate a crash: the log is not checkpointed
+    pq._log_file.close()
+    pq = PersistentPriorityQueue(path)
+    assert len(pq) == 3
+    assert pq.num_logged == 5
+    pq.add_task('f', 5)
+    pq.close()
+    assert pq.generation == 1
+    with PersistentPriorityQueue(path) as pq:
+        assert pq.num_logged == 0
+        assert list(pq) == ['b', 'a', 'd', 'f']
+    with PersistentPriorityQueue(path) as pq:
+        assert pq.empty
+        assert pq.generation == 2
+
+
+def test_persistent_priority_queue_checkpoint_interval(tmp_path):
+    path = tmp_path / 'queue.log'
+    pq = PersistentPriorityQueue(path, checkpoint_interval=10)
+    for i in range(25):
+        pq.add_task(i, -i)
+    assert pq.generation == 2
+    assert pq.num_logged == 5
+    pq._log_file.close()
+    pq = PersistentPriorityQueue(path, checkpoint_interval=10)
+    assert len(pq) == 25
+    assert pq.pop_many(3) == [24, 23, 22]
+    pq.close()
+
+
+def test_persistent_priority_queue_torn_write(tmp_path):
+    path = tmp_path / 'queue.log'
+    pq = PersistentPriorityQueue(path)
+    pq.add_task('a', 1)
+    pq.add_task('b', 2)
+    pq._log_file.close()
+    size = path.stat().st_size
+    with open(str(path), 'r+b') as f:
+        f.truncate(size - 3)
+    pq = PersistentPriorityQueue(path)
+    assert list(pq) == ['a']
+    pq._log_file.close()
+    # the log has been truncated after the last valid record
+    pq = PersistentPriorityQueue(path)
+    assert pq.num_logged == 2
+    assert list(pq) == []
+    pq.close()
+
+
+def test_persistent_priority_queue_stale_log(tmp_path):
+    path = tmp_path / 'queue.log'
+    pq = PersistentPriorityQueue(path)
+    pq.add_task('a', 1)
+    pq._log_file.close()
+    stale_log = path.read_bytes()
+    pq = PersistentPriorityQueue(path)
+    pq.close()
+    # simulate a crash right after writing the checkpoint, before starting the new log
+    path.write_bytes(stale_log)
+    pq = PersistentPriorityQueue(path)
+    assert list(pq) == ['a']
+    pq.close()
+
+
+@pytest.mark.parametrize('processes', [False, True], ids=['local', 'processes'])
+def test_sharded_priority_queue(processes):
+    with ShardedPriorityQueue(num_shards=3, processes=processes) as pq:
+        pq.add_tasks([('a', 3), ('b', 1), ('c', 2), ('d', 2), ('e', 9)])
+        pq.add_task('f', 2)
+        pq.add_task('a', 0)
+        pq.remove_task('e')
+        with pytest.raises(KeyError):
+            pq.remove_task('e')
+        assert len(pq) == 5
+        assert 'a' in pq
+        assert 'e' not in pq
+        assert pq.priority_of('f') == 2
+        assert pq.peek() == 'a'
+        assert pq.pop_task() == 'a'
+        assert pq.pop_until(2) == ['b', 'c', 'd', 'f']
+        assert pq.empty
+        with pytest.raises(EmptyQueueError):
+            pq.pop_task()
+
+
+def test_sharded_priority_queue_same_order_as_priority_queue():
+    rng = random.Random(2)
+    pq1 = PriorityQueue()
+    pq2 = ShardedPriorityQueue(num_shards=5)
+    popped1 = []
+    popped2 = []
+    for _ in range(3000):
+        op = rng.random()
+        task = rng.randrange(100)
+        if op < 0.5:
+            priority = rng.randrange(10)
+            pq1.add_task(task, priority)
+            pq2.add_task(task, priority)
+        elif op < 0.7:
+            if task in pq1:
+                pq1.remove_task(task)
+                pq2.remove_task(task)
+        else:
+            popped1.extend(pq1.pop_many(2))
+            popped2.extend(pq2.pop_many(2))
+        assert len(pq1) == len(pq2)
+    assert popped1 == popped2
+    assert list(pq1) == list(pq2)
+
+
+def test_sharded_priority_queue_batched_pops_with_processes():
+    rng = random.Random(3)
+    pq1 = PriorityQueue()
+    with ShardedPriorityQueue(num_shards=3, processes=True) as pq2:
+        for _ in range(20):
+            tasks = [(rng.randrange(200), rng.randrange(10)) for _ in range(30)]
+            pq1.add_tasks(tasks)
+            pq2.add_tasks(tasks)
+            k = rng.randrange(1, 20)
+            assert pq2.pop_many(k) == pq1.pop_many(k)
+            assert len(pq2) == len(pq1)
+            priority = rng.randrange(3)
+            assert pq2.pop_until(priority) == pq1.pop_until(priority)
+            assert len(pq2) == len(pq1)
+        assert pq2.pop_many(1000) == pq1.pop_many(1000)
+        assert pq2.empty
+
+
+def test_sharded_priority_queue_closed():
+    pq = ShardedPriorityQueue(num_shards=2, processes=True)
+    pq.add_task('a', 1)
+    pq.close()
+    with pytest.raises(ValueError, match='closed'):
+        pq.add_task('b', 1)
+    with pytest.raises(ValueError, match='closed'):
+        pq.pop_task()
+    with pytest.raises(ValueError, match='closed'):
+        'a' in pq
+
+
+def test_instrumented_priority_queue_stats():
+    now = [0.0]
+    pq = InstrumentedPriorityQueue(name='instrumented', clock=lambda: now[0])
+    pq.add_tasks([('a', 1), ('b', 2), ('c', 3), ('a', 0)])
+    pq.add_task('d', 4)
+    pq.add_task('b', 5)
+    now[0] = 0.000003
+    pq.remove_task('c')
+    assert pq.pop_task() == 'a'
+    now[0] = 0.5
+    assert pq.pop_many(5) == ['d', 'b']
+    stats = pq.stats()
+    assert stats == {
+        'num_tasks': 0,
+        'num_removed': 0,
+        'heap_size': 0,
+        'heap_depth': 0,
+        'adds': 4,
+        'updates': 2,
+        'removes': 1,
+        'evictions': 0,
+        'pops': 3,
+        'skipped_removed': 2,
+        'compactions': 0,
+        'latency_histogram': {0.000004: 1, 0.524288: 2},
+    }
+    assert pq.add_times == {}
+
+
+def test_instrumented_priority_queue_maxsize():
+    pq = InstrumentedPriorityQueue(maxsize=2)
+    pq.add_tasks([('a', 1), ('b', 2), ('c', 3), ('d', 0)])
+    pq.compact()
+    stats = pq.stats()
+    assert stats['adds'] == 4
+    assert stats['evictions'] == 2
+    assert stats['removes'] == 0
+    assert stats['compactions'] == 1
+    assert stats['heap_size'] == 2
+    assert len(pq.add_times) == 2
@@ -5,13 +5,55 @@ Author: Marc Gallet
 """
 
 
+import bisect
+import collections
 import hashlib
-import json
+import itertools
+import operator
+import os
+import weakref
 
 from collections import OrderedDict
-from typing import Any, Callable, Dict, Iterator, List
+from collections.abc import Mapping, MutableMapping
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Union
 
-from zkpytb.json import JSONEncoder
+from zkpytb.json import JSONEncoder, canonical_dumps
+
+
+class _Missing:
+    """
+    Type of the MISSING sentinel, returned by lookups which don't find a key.
+
+    It is falsy, empty, and looking up any key in it returns MISSING again, so that
+    chained lookups like adict.peek()['a']['b']['c'] don't need to check each level.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return self
+
+    def __iter__(self):
+        # without it, iteration would fall back to __getitem__ and never end
+        return iter(())
+
+    def __contains__(self, key):
+        return False
+
+    def __len__(self):
+        return 0
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return 'MISSING'
+
+    def __reduce__(self):
+        return 'MISSING'
+
+
+MISSING = _Missing()
 
 
 class AutoDict(dict):
@@ -30,11 +72,119 @@ class AutoDict(dict):
     def to_dict(self):
         """
         Convert this AutoDict to a normal dict (without autovivification).
+
+        The tree is walked with an explicit stack instead of recursion, so it works at any depth.
+        Values which are not AutoDicts are not copied.
+        """
+        result = self._base_class(self)
+        stack = [(self, result)]
+        while stack:
+            node, node_copy = stack.pop()
+            # values which aren't AutoDicts have already been copied (by reference) with the whole node
+            for key, child in [(key, val) for key, val in node.items() if isinstance(val, AutoDict)]:
+                child_copy = node_copy[key] = child._base_class(child)
+                stack.append((child, child_copy))
+        return result
+
+    def set_path(self, path, value):
+        """
+        Set the value at the given path (sequence of keys), same as self[path[0]]...[path[-1]] = value
+        but without going through __getitem__ at each level.
         """
-        return self._base_class(
-            (key, (val.to_dict() if isinstance(val, AutoDict) else val))
-            for key, val in self.items()
-        )
+        if not path:
+            raise ValueError('path must contain at least one key')
+        node = self
+        for key in path[:-1]:
+            if isinstance(node, AutoDict):
+                child = dict.get(node, key, MISSING)
+                if child is MISSING:
+                    child = node[key] = type(node)()
+                node = child
+            else:
+                node = node[key]
+        node[path[-1]] = value
+
+    def get_path(self, path, default=None):
+        """
+        Return the value at the given path (sequence of keys), or default if it doesn't exist.
+
+        Missing keys are not created.
+        """
+        node = self
+        for key in path:
+            if not isinstance(node, dict):
+                return default
+            node = dict.get(node, key, MISSING)
+            if node is MISSING:
+                return default
+        return node
+
+    def bulk_set(self, items):
+        """
+        Set the values from an iterable of (path, value) pairs, see set_path().
+
+        The nodes along the last path are cached, so that consecutive paths sharing
+        a prefix (for example sorted paths) don't walk down from the root again.
+        """
+        prefix = ()
+        nodes = [self]  # nodes[i] is the node at prefix[:i]
+        for path, value in items:
+            if not path:
+                raise ValueError('path must contain at least one key')
+            parents = tuple(path[:-1])
+            if parents != prefix:
+                common = 0
+                for key, prefix_key in zip(parents, prefix):
+                    if key != prefix_key:
+                        break
+                    common += 1
+                del nodes[common + 1:]
+                node = nodes[-1]
+                for key in parents[common:]:
+                    if isinstance(node, AutoDict):
+                        child = dict.get(node, key, MISSING)
+                        if child is MISSING:
+                            child = node[key] = type(node)()
+                        node = child
+                    else:
+                        node = node[key]
+                    nodes.append(node)
+                prefix = parents
+            nodes[-1][path[-1]] = value
+
+    def prune_empty(self):
+        """
+        Remove the empty AutoDicts from the tree, e.g. branches created by lookups of missing keys.
+
+        Branches which only contain empty AutoDicts are removed as well. Return the number of removed AutoDicts.
+        """
+        # parents always come before their children in this list
+        branches = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            for key, val in node.items():
+                if isinstance(val, AutoDict):
+                    branches.append((node, key, val))
+                    stack.append(val)
+        num_removed = 0
+        for parent, key, node in reversed(branches):
+            if not node:
+                del parent[key]
+                num_removed += 1
+        return num_removed
+
+    def peek(self):
+        """
+        Return a read-only view of this AutoDict where missing keys return MISSING instead of being created.
+        """
+        return AutoDictPeekView(self)
+
+    def freeze(self):
+        """
+        Return a read-only view of this AutoDict (without autovivification), without copying anything.
+        """
+        return AutoDictView(self)
 
 
 class AutoOrderedDict(OrderedDict, AutoDict):
@@ -44,6 +194,446 @@ class AutoOrderedDict(OrderedDict, AutoDict):
     _base_class = OrderedDict
 
 
+class AutoDictView(Mapping):
+    """
+    Read-only view of an AutoDict, where missing keys raise KeyError instead of being created.
+
+    Nested AutoDicts are wrapped in views when they are accessed. The view reflects
+    later changes made to the underlying AutoDict.
+    """
+    __slots__ = ('_autodict',)
+
+    def __init__(self, autodict: AutoDict):
+        self._autodict = autodict
+
+    def __getitem__(self, key):
+        value = self._autodict._base_class.__getitem__(self._autodict, key)
+        if isinstance(value, AutoDict):
+            return type(self)(value)
+        return value
+
+    def __iter__(self):
+        return iter(self._autodict)
+
+    def __len__(self):
+        return len(self._autodict)
+
+    def __contains__(self, key):
+        return key in self._autodict
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self._autodict)
+
+    def to_dict(self):
+        return self._autodict.to_dict()
+
+
+class AutoDictPeekView(AutoDictView):
+    """
+    Read-only view of an AutoDict, where missing keys return MISSING instead of being created.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        value = dict.get(self._autodict, key, MISSING)
+        if isinstance(value, AutoDict):
+            return type(self)(value)
+        return value
+
+    def get(self, key, default=None):
+        value = self[key]
+        return default if value is MISSING else value
+
+
+class _MerkleMixin:
+    """
+    Mixin for AutoDict classes which keeps track of modifications for merkle_hashdict().
+
+    The digests computed by merkle_hashdict() are cached in each node, and every modification
+    of a node clears its cached digests and the ones of its ancestors.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._merkle_digests = {}            # mapping of hash methods to the digest of this node
+        self._merkle_parents = []            # weak references to the nodes containing this one
+        super().__init__(*args, **kwargs)
+        for value in dict.values(self):
+            if isinstance(value, _MerkleMixin):
+                value._merkle_add_parent(self)
+
+    def __reduce__(self):
+        return type(self), (list(self.items()),)
+
+    def _merkle_add_parent(self, parent):
+        for parent_ref in self._merkle_parents:
+            if parent_ref() is parent:
+                return
+        self._merkle_parents.append(weakref.ref(parent))
+
+    def invalidate_digest(self):
+        """
+        Clear the cached digests of this node and of its ancestors.
+
+        This is done automatically when the node is modified, but it must be called explicitly
+        after modifying in place a value which isn't an AutoDict of the same class (e.g. a list).
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            # the ancestors of a node without cached digests don't have cached digests either
+            if node._merkle_digests:
+                node._merkle_digests.clear()
+                stack.extend(parent for parent in (ref() for ref in node._merkle_parents) if parent is not None)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.invalidate_digest()
+        if isinstance(value, _MerkleMixin):
+            value._merkle_add_parent(self)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.invalidate_digest()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        super().clear()
+        self.invalidate_digest()
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self.invalidate_digest()
+        return value
+
+    def popitem(self, *args):
+        item = super().popitem(*args)
+        self.invalidate_digest()
+        return item
+
+    def setdefault(self, key, default=None):
+        value = dict.get(self, key, MISSING)
+        if value is MISSING:
+            value = self[key] = default
+        return value
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+
+class MerkleAutoDict(_MerkleMixin, AutoDict):
+    """
+    AutoDict which caches its digests computed by merkle_hashdict(), see _MerkleMixin.
+    """
+
+
+class MerkleAutoOrderedDict(_MerkleMixin, AutoOrderedDict):
+    """
+    AutoOrderedDict which caches its digests computed by merkle_hashdict(), see _MerkleMixin.
+    """
+
+
+def _flatten_mapping(mapping: Mapping) -> Iterator[Any]:
+    """
+    Yield the (path, value) pairs of the leaves of a nested mapping, empty mappings are skipped.
+    """
+    stack = [((), iter(mapping.items()))]
+    while stack:
+        prefix, items = stack[-1]
+        for key, value in items:
+            if isinstance(value, Mapping):
+                stack.append((prefix + (key,), iter(value.items())))
+                break
+            yield prefix + (key,), value
+        else:
+            stack.pop()
+
+
+class _FlatAutoDictNode(MutableMapping):
+    """
+    Node of a FlatAutoDict: mapping view of the leaves of the FlatAutoDict starting with a given prefix.
+
+    Nodes don't store anything themselves, they are created on the fly when accessing a key
+    which is not a leaf, just like AutoDict creates the missing nested dicts.
+    """
+    __slots__ = ('_root', '_prefix')
+
+    def __init__(self, root: 'FlatAutoDict', prefix: tuple):
+        self._root = root
+        self._prefix = prefix
+
+    def __getitem__(self, key):
+        path = self._prefix + (key,)
+        value = self._root._leaves.get(path, MISSING)
+        if value is MISSING:
+            return _FlatAutoDictNode(self._root, path)
+        return value
+
+    def __setitem__(self, key, value):
+        self._root._set(self._prefix + (key,), value)
+
+    def __delitem__(self, key):
+        if not self._root._delete(self._prefix + (key,)):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._root._children.get(self._prefix, ())
+
+    def __iter__(self):
+        # the keys in the order they were first added, iterated over a copy like dict views forbid changes
+        return iter(list(self._root._children.get(self._prefix, ())))
+
+    def __len__(self):
+        return len(self._root._children.get(self._prefix, ()))
+
+    # __getitem__ never raises KeyError, so the Mapping helpers which rely on it must be overridden
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self[key]
+        if isinstance(value, _FlatAutoDictNode):
+            value = value.to_dict()
+        del self[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.to_dict())
+
+    def items(self, prefix=None):
+        """
+        Without prefix, same as dict.items().
+
+        With a prefix (sequence of keys, possibly empty), iterate over the (path, value) pairs
+        of the leaves starting with this prefix, where the paths are tuples of keys relative
+        to this node. The leaves are sorted by path if all the keys can be compared with each other,
+        otherwise they are in the insertion order of the keys at each level.
+        """
+        if prefix is None:
+            return super().items()
+        return self._iter_leaves(tuple(prefix))
+
+    def _iter_leaves(self, prefix):
+        root = self._root
+        depth = len(self._prefix)
+        full_prefix = self._prefix + prefix
+        if full_prefix in root._leaves:
+            yield prefix, root._leaves[full_prefix]
+        for path in root._paths_under(full_prefix):
+            yield path[depth:], root._leaves[path]
+
+    def get_path(self, path, default=None):
+        """
+        Return the value at the given path (sequence of keys), or default if it doesn't exist.
+        """
+        path = self._prefix + tuple(path)
+        value = self._root._leaves.get(path, MISSING)
+        if value is not MISSING:
+            return value
+        if path and path in self._root._children:
+            return _FlatAutoDictNode(self._root, path)
+        return default
+
+    def set_path(self, path, value):
+        """
+        Set the value at the given path (sequence of keys), same as self[path[0]]...[path[-1]] = value.
+        """
+        if not path:
+            raise ValueError('path must contain at least one key')
+        self._root._set(self._prefix + tuple(path), value)
+
+    def to_dict(self):
+        """
+        Convert this node to nested dicts.
+        """
+        result = {}
+        for path, value in self._iter_leaves(()):
+            node = result
+            for key in path[:-1]:
+                node = node.setdefault(key, {})
+            node[path[-1]] = value
+        return result
+
+    def to_autodict(self, cls=None):
+        """
+        Convert this node to an AutoDict (or to an instance of the given AutoDict subclass).
+        """
+        result = (cls or AutoDict)()
+        result.bulk_set(self._iter_leaves(()))
+        return result
+
+
+class FlatAutoDict(_FlatAutoDictNode):
+    """
+    Compact alternative to AutoDict, which stores all the leaves in a single dict keyed by their paths (tuples).
+
+    It offers the same d[a][b][c] ergonomics as AutoDict, but the intermediate levels are views created
+    on the fly instead of dicts, which uses much less memory for deep and sparse trees.
+
+    Differences with AutoDict:
+
+    * Accessing a missing key doesn't create anything, so the tree never contains empty branches.
+    * Setting a mapping as a value stores its leaves (a copy), and empty mappings are not stored.
+    * The leaves under a prefix can be iterated with items(prefix=...), which uses a sorted index of the paths
+      when all the keys can be compared with each other.
+
+    The keys of each node, with the number of leaves under each of them, are indexed by prefix so that
+    len(), iteration and membership tests don't depend on the size of the tree. The index of the sorted
+    paths is updated with bisect on each new or deleted leaf.
+    """
+    __slots__ = ('_leaves', '_children', '_sorted_paths')
+
+    def __init__(self, data: Optional[Mapping] = None):
+        super().__init__(self, ())
+        self._leaves = {}
+        # {prefix: {key: number of leaves at or under prefix + (key,)}} for all the nodes, including the root
+        self._children = {(): {}}
+        # sorted list of the paths of the leaves, or None when some keys can't be compared with each other
+        self._sorted_paths = []
+        if data is not None:
+            self.update(data)
+
+    @classmethod
+    def from_dict(cls, dict_in: Mapping) -> 'FlatAutoDict':
+        """
+        Create a FlatAutoDict from nested mappings (dicts, AutoDicts...).
+        """
+        return cls(dict_in)
+
+    def __reduce__(self):
+        return type(self)._from_leaves, (self._leaves,)
+
+    @classmethod
+    def _from_leaves(cls, leaves):
+        result = cls()
+        for path, value in leaves.items():
+            result._set(path, value)
+        return result
+
+    def clear(self):
+        self._leaves.clear()
+        self._children = {(): {}}
+        self._sorted_paths = []
+
+    def _sorted_range(self, prefix):
+        """
+        Return the (start, end) slice of the sorted paths which start with prefix (or are prefix),
+        or None if the sorted index can't be used.
+        """
+        paths = self._sorted_paths
+        if paths is None:
+            return None
+        try:
+            # the prefix itself sorts before all the paths which start with it
+            start = bisect.bisect_left(paths, prefix)
+        except TypeError:
+            return None
+        depth = len(prefix)
+        end = start
+        while end < len(paths) and paths[end][:depth] == prefix:
+            end += 1
+        return start, end
+
+    def _paths_under(self, prefix):
+        """
+        Return the list of the paths of the leaves strictly under prefix.
+        """
+        if prefix not in self._children:
+            return []
+        sorted_range = self._sorted_range(prefix)
+        if sorted_range is not None:
+            start, end = sorted_range
+            return [path for path in self._sorted_paths[start:end] if path != prefix]
+        result = []
+        # pushed in reverse so that the keys are visited in insertion order
+        stack = [prefix + (key,) for key in reversed(list(self._children[prefix]))]
+        while stack:
+            path = stack.pop()
+            children = self._children.get(path)
+            if children is None:
+                result.append(path)
+            else:
+                stack.extend(path + (key,) for key in reversed(list(children)))
+        return result
+
+    def _set(self, path, value):
+        if isinstance(value, _FlatAutoDictNode):
+            value = value.to_dict()
+        if isinstance(value, Mapping):
+            self._delete(path)
+            for subpath, leaf in _flatten_mapping(value):
+                self._set(path + subpath, leaf)
+            return
+        leaves = self._leaves
+        if path not in leaves:
+            if path in self._children:
+                self._delete(path)
+            # a leaf on the path is replaced by a node
+            for i in range(1, len(path)):
+                if path[:i] in leaves:
+                    self._delete(path[:i])
+            for i in range(len(path)):
+                children = self._children.get(path[:i])
+                if children is None:
+                    children = self._children[path[:i]] = {}
+                children[path[i]] = children.get(path[i], 0) + 1
+            if self._sorted_paths is not None:
+                try:
+                    bisect.insort(self._sorted_paths, path)
+                except TypeError:
+                    self._sorted_paths = None
+        leaves[path] = value
+
+    def _delete(self, path):
+        """
+        Delete the leaf at path or all the leaves under it, return the number of deleted leaves.
+        """
+        paths = self._paths_under(path)
+        if path in self._leaves:
+            paths.append(path)
+        if not paths:
+            return 0
+        for leaf_path in paths:
+            del self._leaves[leaf_path]
+        # update the number of leaves under each prefix of path, and drop the nodes left empty
+        children_index = self._children
+        for i in range(len(path) - 1, -1, -1):
+            prefix = path[:i]
+            children = children_index[prefix]
+            count = children[path[i]] - len(paths)
+            if count:
+                children[path[i]] = count
+            else:
+                del children[path[i]]
+                if prefix and not children:
+                    del children_index[prefix]
+        stack = [path]
+        while stack:
+            node = stack.pop()
+            children = children_index.pop(node, None)
+            if children:
+                stack.extend(node + (key,) for key in children)
+        sorted_range = self._sorted_range(path)
+        if sorted_range is not None:
+            del self._sorted_paths[sorted_range[0]:sorted_range[1]]
+        return len(paths)
+
+
 def filter_dict_callfunc(dict_in: Dict, func: Callable[..., bool]) -> Dict:
     assert isinstance(dict_in, dict)
     assert callable(func)
@@ -58,42 +648,312 @@ def filter_dict_only_scalar_values(dict_in: Dict) -> Dict:
 def filter_dict_with_keylist(dict_in: Dict, keylist: List, blacklistmode=False) -> Dict:
     assert isinstance(dict_in, dict)
     assert isinstance(keylist, list)
+    try:
+        keys = frozenset(keylist)
+    except TypeError:
+        # unhashable items can't be keys of dict_in anyway, but keep the list for the comparisons
+        keys = keylist
     if blacklistmode:
-        return {k: v for (k, v) in dict_in.items() if k not in keylist}
+        return {k: v for (k, v) in dict_in.items() if k not in keys}
+    else:
+        return {k: v for (k, v) in dict_in.items() if k in keys}
+
+
+class DictFilter:
+    """
+    Reusable filter for dicts, combining the criteria of the filter_dict_* functions.
+
+    The arguments are checked and the filter is compiled once, at creation:
+    the keylist is turned into a frozenset (or kept as a list if some items are unhashable), and
+    a dedicated comprehension is used when there is a single criterion. A key/value pair is kept
+    if it matches all the criteria:
+
+    * keylist: the key is in keylist (or not in keylist if blacklistmode is True)
+    * only_scalar_values: the value is not iterable
+    * func: func(key, value) is true
+
+    The filter is applied with filter(d) (or simply calling it), filter_many(dicts) for
+    a stream of dicts, filter_batch(dicts) for a list of dicts, or filter_inplace(d).
+    """
+
+    def __init__(self, keylist: Optional[Iterable] = None, blacklistmode=False, only_scalar_values=False,
+                 func: Optional[Callable[..., bool]] = None):
+        assert func is None or callable(func)
+        if keylist is None:
+            self.keys = None
+        else:
+            keylist = list(keylist)
+            try:
+                self.keys = frozenset(keylist)
+            except TypeError:
+                # unhashable items can't be keys of dict_in anyway, but keep the list for the comparisons
+                self.keys = keylist
+        self.blacklistmode = blacklistmode
+        self.only_scalar_values = only_scalar_values
+        self.func = func
+        self.filter = self._compile()
+
+    def __call__(self, dict_in: Dict) -> Dict:
+        return self.filter(dict_in)
+
+    def _compile(self) -> Callable[[Dict], Dict]:
+        keys = self.keys
+        blacklistmode = self.blacklistmode
+        func = self.func
+        criteria = []
+        if keys is not None:
+            if blacklistmode:
+                criteria.append(lambda k, v: k not in keys)
+            else:
+                criteria.append(lambda k, v: k in keys)
+        if self.only_scalar_values:
+            criteria.append(lambda k, v: not hasattr(v, '__iter__'))
+        if func is not None:
+            criteria.append(func)
+
+        if not criteria:
+            return dict
+        if len(criteria) > 1:
+            return lambda dict_in: {k: v for (k, v) in dict_in.items() if all(c(k, v) for c in criteria)}
+        # single criterion: inline it in the comprehension
+        if func is not None:
+            return lambda dict_in: {k: v for (k, v) in dict_in.items() if func(k, v)}
+        if keys is None:
+            return lambda dict_in: {k: v for (k, v) in dict_in.items() if not hasattr(v, '__iter__')}
+        if blacklistmode:
+            return lambda dict_in: {k: v for (k, v) in dict_in.items() if k not in keys}
+        return lambda dict_in: {k: v for (k, v) in dict_in.items() if k in keys}
+
+    def filter_many(self, dicts: Iterable[Dict]) -> Iterator[Dict]:
+        return map(self.filter, dicts)
+
+    def filter_batch(self, dicts: Iterable[Dict]) -> List[Dict]:
+        return list(map(self.filter, dicts))
+
+    def filter_inplace(self, dict_in: Dict) -> None:
+        """Remove the keys which don't match the filter from dict_in."""
+        kept = self.filter(dict_in)
+        if len(kept) != len(dict_in):
+            for k in [k for k in dict_in if k not in kept]:
+                del dict_in[k]
+
+
+class MergeConflictError(ValueError):
+    """
+    Raised by merge_dicts(conflict='raise') when both dicts have a value for the same key
+    and they are not both dicts.
+    """
+
+    def __init__(self, path, old, new):
+        super().__init__('conflicting values at {!r}: {!r} and {!r}'.format(path, old, new))
+        self.path = path
+        self.old = old
+        self.new = new
+
+
+def _merge_conflict_raise(path, old, new):
+    raise MergeConflictError(path, old, new)
+
+
+def _merge_conflict_append(path, old, new):
+    if isinstance(old, list) and isinstance(new, list):
+        return old + new
+    return new
+
+
+_merge_conflict_strategies = {
+    'raise': _merge_conflict_raise,
+    'append': _merge_conflict_append,
+}
+
+
+def merge_dicts(*dicts: Dict, conflict='override', inplace=False) -> Dict:
+    """
+    Deep merge any number of dicts, the values from the later dicts taking precedence.
+
+    Nested dicts present on both sides are merged. Other conflicting values are resolved
+    according to conflict:
+
+    * 'override': the value from the later dict wins
+    * 'raise': raise MergeConflictError
+    * 'append': lists are concatenated, other values are overridden
+    * a callable f(path, old, new) returning the value to keep, where path is the tuple of keys
+
+    The result contains the keys of the first dict followed by the new keys of the next ones,
+    in order. Subtrees which only exist in one of the dicts are reused by reference, only the
+    nested dicts which need to be merged are copied. With inplace=True, the first dict (and the
+    nested dicts it contains) is updated in place and returned, instead of a new dict.
+
+    The merge is done with an explicit stack, so it works at any depth.
+    """
+    assert all(isinstance(d, dict) for d in dicts)
+    if conflict == 'override':
+        resolve = None
+    elif callable(conflict):
+        resolve = conflict
+    elif conflict in _merge_conflict_strategies:
+        resolve = _merge_conflict_strategies[conflict]
     else:
-        return {k: v for (k, v) in dict_in.items() if k in keylist}
+        raise ValueError('unknown conflict strategy: {!r}'.format(conflict))
+    if not dicts:
+        return {}
+    result = dicts[0] if inplace else dict(dicts[0])
+    # The dicts which can be updated are the ones created by this merge, and with inplace=True
+    # the ones from the first dict, i.e. the nested dicts of these which weren't put there by reference.
+    owned = {id(result)}  # ids of the dicts created by this merge
+    borrowed = set()      # ids of the dicts put in the result by reference from the later dicts
+    for source in dicts[1:]:
+        stack = [(result, source, (), inplace)]
+        while stack:
+            target, source_node, path, in_first_dict = stack.pop()
+            for key, value in source_node.items():
+                old = dict.get(target, key, MISSING)
+                if old is MISSING:
+                    target[key] = value
+                    if isinstance(value, dict):
+                        borrowed.add(id(value))
+                elif isinstance(old, dict) and isinstance(value, dict):
+                    if old is value:
+                        continue
+                    # the copies made by this merge (and their subtrees) are never part of the first dict
+                    old_in_first_dict = in_first_dict and id(old) not in borrowed and id(old) not in owned
+                    if not old_in_first_dict and id(old) not in owned:
+                        old = target[key] = dict(old)
+                        owned.add(id(old))
+                    stack.append((old, value, path + (key,), old_in_first_dict))
+                else:
+                    if resolve is not None:
+                        value = resolve(path + (key,), old, value)
+                    target[key] = value
+                    if isinstance(value, dict):
+                        borrowed.add(id(value))
+    return result
 
 
 def mergedicts(dict1, dict2) -> Iterator[Any]:
     assert isinstance(dict1, dict)
     assert isinstance(dict2, dict)
-    for k in set(dict1.keys()).union(dict2.keys()):
-        if k in dict1 and k in dict2:
-            if isinstance(dict1[k], dict) and isinstance(dict2[k], dict):
-                yield (k, dict(mergedicts(dict1[k], dict2[k])))
-            else:
-                # If one of the values is not a dict, you can't continue merging it.
-                # Value from second dict overrides one in first and we move on.
-                yield (k, dict2[k])
-                # Alternatively, replace this with exception raiser to alert you of value conflicts
-        elif k in dict1:
-            yield (k, dict1[k])
-        else:
-            yield (k, dict2[k])
+    yield from merge_dicts(dict1, dict2).items()
+
+
+# same settings as json.dumps(sort_keys=True, cls=JSONEncoder), created once and reused
+_stable_json_encoder = JSONEncoder(sort_keys=True)
 
 
 def dict_stable_json_repr(dict_in: Dict) -> str:
-    return json.dumps(dict_in, sort_keys=True, cls=JSONEncoder)
+    return _stable_json_encoder.encode(dict_in)
+
+
+def hashdict(dict_in: Dict, method='sha1', streaming=False, chunk_size=65536, canonical=False) -> str:
+    """
+    Hash the stable json representation of a dict.
 
+    With streaming=True, the json representation is never built in memory as a whole:
+    it is generated and fed to the hash object by chunks of about chunk_size characters.
+    This is slower but the memory used doesn't depend on the size of the dict.
+    The hash is the same in both cases.
 
-def hashdict(dict_in: Dict, method='sha1') -> str:
+    With canonical=True, the canonical json representation (see zkpytb.json.canonical_dumps()) is hashed instead,
+    which is better specified (e.g. for cache keys shared between programs) but gives different hashes.
+    """
     assert isinstance(dict_in, dict)
     h = hashlib.new(method)
-    dict_repr = dict_stable_json_repr(dict_in)
-    h.update(dict_repr.encode('utf-8'))
+    if canonical:
+        if streaming:
+            raise ValueError('streaming is not supported with canonical=True')
+        h.update(canonical_dumps(dict_in, as_bytes=True))
+        return h.hexdigest()
+    if not streaming:
+        dict_repr = dict_stable_json_repr(dict_in)
+        h.update(dict_repr.encode('utf-8'))
+        return h.hexdigest()
+    buf = []
+    buf_size = 0
+    for chunk in _stable_json_encoder.iterencode(dict_in):
+        buf.append(chunk)
+        buf_size += len(chunk)
+        if buf_size >= chunk_size:
+            h.update(''.join(buf).encode('utf-8'))
+            buf = []
+            buf_size = 0
+    h.update(''.join(buf).encode('utf-8'))
     return h.hexdigest()
 
 
+def _hashdict_chunk(dicts: List[Dict], method: str) -> List[str]:
+    return [hashdict(d, method) for d in dicts]
+
+
+def hashdicts(dicts: Iterable[Dict], method='sha1', workers: Optional[int] = None,
+              chunksize: int = 1000) -> Iterator[str]:
+    """
+    Hash many dicts in parallel, yielding the same hashes as hashdict() in the same order.
+
+    The dicts are sent by chunks of chunksize to a pool of worker processes (os.cpu_count()
+    by default). The input is consumed lazily, with at most two chunks per worker in flight.
+    With workers=1, the dicts are hashed in the current process.
+    """
+    if chunksize < 1:
+        raise ValueError('chunksize must be at least 1')
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for d in dicts:
+            yield hashdict(d, method)
+        return
+    dicts = iter(dicts)
+    chunks = iter(lambda: list(itertools.islice(dicts, chunksize)), [])
+    with ProcessPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_hashdict_chunk, chunk, method))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def merkle_hashdict(dict_in: Dict, method='sha1') -> str:
+    """
+    Hash a dict as a Merkle tree: each nested dict is hashed separately and only its digest
+    is included in the hash of its parent.
+
+    The digests of MerkleAutoDict/MerkleAutoOrderedDict nodes are cached and cleared when they
+    are modified, so that hashing again a large tree after a small change only recomputes the
+    digests along the modified path. The digests of other dicts are recomputed every time.
+
+    This doesn't give the same hash as hashdict().
+    """
+    assert isinstance(dict_in, dict)
+    digests = {}  # digests of the nodes without cache computed during this call, by id
+
+    def cached_digest(node):
+        if isinstance(node, _MerkleMixin):
+            return node._merkle_digests.get(method)
+        return digests.get(id(node))
+
+    stack = [(dict_in, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if cached_digest(node) is not None:
+            continue
+        if not children_done:
+            stack.append((node, True))
+            stack.extend((val, False) for val in node.values() if isinstance(val, dict))
+            continue
+        # nested dicts are tagged, so that they can't be confused with a value
+        node_repr = _stable_json_encoder.encode({
+            key: (['d', cached_digest(val)] if isinstance(val, dict) else ['v', val])
+            for key, val in node.items()
+        })
+        digest = hashlib.new(method, node_repr.encode('utf-8')).hexdigest()
+        if isinstance(node, _MerkleMixin):
+            node._merkle_digests[method] = digest
+        else:
+            digests[id(node)] = digest
+    return cached_digest(dict_in)
+
+
 def dict_values_map(f: Callable, d: Dict) -> Dict:
     """
     Simple helper to apply a function to the values of a dictionary.
@@ -101,3 +961,80 @@ def dict_values_map(f: Callable, d: Dict) -> Dict:
     This is similar to built-in map() but only accept one iterable dict.
     """
     return {k: f(v) for k, v in d.items()}
+
+
+def records_to_columns(records: List[Dict]) -> Dict[Any, List]:
+    """
+    Convert a list of dicts which all have the same keys to a dict of columns (lists of values).
+
+    Raise ValueError if the dicts don't all have the same keys.
+    Records which are all empty give an empty dict of columns.
+    """
+    if not records:
+        return {}
+    keys = list(records[0])
+    num_keys = len(keys)
+    if any(len(record) != num_keys for record in records):
+        raise ValueError('all the records must have the same keys')
+    if num_keys == 0:
+        return {}
+    try:
+        if num_keys == 1:
+            return {keys[0]: list(map(operator.itemgetter(keys[0]), records))}
+        columns = zip(*map(operator.itemgetter(*keys), records))
+        return dict(zip(keys, map(list, columns)))
+    except KeyError:
+        raise ValueError('all the records must have the same keys')
+
+
+def columns_to_records(columns: Dict[Any, Iterable]) -> List[Dict]:
+    """
+    Convert a dict of columns (sequences of values of the same length) to a list of dicts.
+
+    An empty dict of columns gives an empty list: the number of records can't be known without any column.
+    """
+    keys = list(columns)
+    columns = [column.tolist() if hasattr(column, 'tolist') else list(column) for column in columns.values()]
+    if len(set(map(len, columns))) > 1:
+        raise ValueError('all the columns must have the same length')
+    return list(map(dict, map(zip, itertools.repeat(keys), zip(*columns))))
+
+
+def dict_values_map_batch(f: Union[Callable, Dict[Any, Callable]], records: List[Dict],
+                          vectorized=False, columnar=False) -> Union[List[Dict], Dict[Any, Any]]:
+    """
+    Apply a function to the values of many dicts which all have the same keys, see dict_values_map().
+
+    The records are converted to columns first, so that the function is applied column by column
+    instead of looping over each key of each record in Python:
+
+    * f is either a function applied to all the columns or a dict of functions by key,
+      in which case the columns without function are left unchanged.
+    * With vectorized=False, the function is applied to each value of the column.
+      With vectorized=True, the function is applied once to the whole column (a list)
+      and must return a sequence of the same length, e.g. a numpy array.
+    * With columnar=True, the dict of columns is returned instead of rebuilding the records.
+
+    Rebuilding the records costs about as much as the columns save, so this is only faster
+    than calling dict_values_map() on each record with columnar=True, or when the vectorized
+    function is much faster than a Python loop. Raise ValueError if a vectorized function
+    doesn't return as many values as there are records.
+    """
+    columns = records_to_columns(records)
+    for key, column in columns.items():
+        func = f.get(key) if isinstance(f, dict) else f
+        if func is None:
+            continue
+        if vectorized:
+            column = func(column)
+            if len(column) != len(records):
+                raise ValueError('the function returned {} values for column {!r} instead of {}'.format(
+                    len(column), key, len(records)))
+            columns[key] = column
+        else:
+            columns[key] = list(map(func, column))
+    if columnar:
+        return columns
+    if not columns:
+        return [{} for _ in records]
+    return columns_to_records(columns)
@@ -7,33 +7,612 @@ Author: Marc Gallet
 
 import datetime
 import decimal
+import enum
+import gzip
+import io
+import itertools
 import json
+import math
+import mmap
+import os
+import re
+import sys
 import uuid
 import pathlib
 
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _convert_path(o):
+    return str(o).replace('\\', '/')
+
+
+def _convert_isoformat(o):
+    return o.isoformat()
+
+
+def _convert_timedelta(o):
+    return o.total_seconds()
+
 
 class JSONEncoder(json.JSONEncoder):
     """
     A custom JSONEncoder that can handle a bit more data types than the one from stdlib.
+
+    The conversion functions are looked up by type in a registry, see register().
+
+    numpy and pandas objects are supported as well, without importing numpy or pandas in this module:
+    their conversion functions are registered the first time an object of these packages is encoded.
+    Arrays, Series and DataFrames (as a list of records) are converted column by column with tolist().
+    NaN and infinities are encoded like python floats (NaN or Infinity, or ValueError with allow_nan=False),
+    and the missing values NaT and NA, as well as the missing values of the columns which aren't floats,
+    are encoded as null.
+
+    These conversions build the whole list of python objects (e.g. all the records of a DataFrame)
+    before it is encoded, which takes much more memory than the object itself:
+    use iterencode_chunked() to bound the memory used by large objects.
     """
+    _converters = {
+        pathlib.Path: _convert_path,
+        uuid.UUID: str,
+        datetime.datetime: _convert_isoformat,
+        datetime.time: _convert_isoformat,
+        datetime.date: _convert_isoformat,
+        datetime.timedelta: _convert_timedelta,
+        complex: str,
+        decimal.Decimal: str,
+    }
+    # exact type -> conversion function (or None if the type isn't supported)
+    _dispatch_cache = {}
+
+    @classmethod
+    def register(cls, type_, converter):
+        """
+        Register a function converting the instances of the given type (and of its subclasses)
+        to objects which can be serialized to json.
+
+        Registering on a subclass of JSONEncoder doesn't affect its parent classes.
+        """
+        if '_converters' not in cls.__dict__:
+            cls._converters = {}
+        cls._converters[type_] = converter
+        classes = [cls]
+        while classes:
+            klass = classes.pop()
+            klass._dispatch_cache = {}
+            classes.extend(klass.__subclasses__())
+
+    @classmethod
+    def _resolve_converter(cls, type_):
+        """
+        Find the conversion function for the given type by walking its MRO, and cache it.
+        """
+        register_package_converters = _package_converters.pop(type_.__module__.partition('.')[0], None)
+        if register_package_converters is not None:
+            register_package_converters()
+        registries = [klass.__dict__['_converters'] for klass in cls.__mro__ if '_converters' in klass.__dict__]
+        converter = None
+        for base in type_.__mro__:
+            converter = next((registry[base] for registry in registries if base in registry), None)
+            if converter is not None:
+                break
+        cls._dispatch_cache[type_] = converter
+        return converter
 
     def default(self, o):
-        # early passthrough if it works by default
         try:
+            converter = self._dispatch_cache[type(o)]
+        except KeyError:
+            converter = self._resolve_converter(type(o))
+        if converter is None:
+            # Let the base class default method raise the TypeError
             return json.JSONEncoder.default(self, o)
-        except Exception:
+        return converter(o)
+
+
+def _convert_numpy_scalar(o):
+    if o.dtype.kind in 'mM':
+        # numpy only converts datetimes and timedeltas with a resolution up to microseconds to python objects
+        o = o.astype(o.dtype.kind + '8[us]')
+    return o.item()
+
+
+def _convert_ndarray(o):
+    if o.dtype.kind in 'mM':
+        o = o.astype(o.dtype.kind + '8[us]')
+    return o.tolist()
+
+
+def _convert_missing(o):
+    return None
+
+
+def _series_to_list(s) -> list:
+    # the missing values of some non-float dtypes are NaN (e.g. the str dtype of pandas 3),
+    # they are encoded as null like NaT and NA, only the float dtypes keep their NaN
+    if s.dtype.kind not in 'fc' and s.hasnans:
+        return [None if missing else value for value, missing in zip(s.tolist(), s.isna().tolist())]
+    return s.tolist()
+
+
+def _frame_to_records(df) -> list:
+    columns = df.columns.tolist()
+    if not columns:
+        return [{} for _ in range(len(df))]
+    values = [_series_to_list(df.iloc[:, i]) for i in range(len(columns))]
+    return list(map(dict, map(zip, itertools.repeat(columns), zip(*values))))
+
+
+def _register_numpy_converters():
+    import numpy as np
+    JSONEncoder.register(np.generic, _convert_numpy_scalar)
+    JSONEncoder.register(np.ndarray, _convert_ndarray)
+
+
+def _register_pandas_converters():
+    import pandas as pd
+    JSONEncoder.register(type(pd.NaT), _convert_missing)
+    JSONEncoder.register(type(pd.NA), _convert_missing)
+    JSONEncoder.register(pd.DataFrame, _frame_to_records)
+    JSONEncoder.register(pd.Series, _series_to_list)
+    JSONEncoder.register(pd.Index, _series_to_list)
+
+
+# top-level package -> function registering the conversion functions of its types
+_package_converters = {
+    'numpy': _register_numpy_converters,
+    'pandas': _register_pandas_converters,
+}
+
+
+def _array_kind(obj) -> Optional[str]:
+    np = sys.modules.get('numpy')
+    if np is not None and isinstance(obj, np.ndarray) and obj.ndim > 0:
+        return 'array'
+    pd = sys.modules.get('pandas')
+    if pd is not None and isinstance(obj, pd.DataFrame):
+        return 'frame'
+    if pd is not None and isinstance(obj, (pd.Series, pd.Index)):
+        return 'series'
+    return None
+
+
+def _encode_key(encoder: json.JSONEncoder, key) -> str:
+    text = encoder.encode({key: 0})
+    return text[1:-len(encoder.key_separator) - 2]
+
+
+def _iterencode_rows(encoder: json.JSONEncoder, num_rows: int, get_rows, chunk_size: int) -> Iterator[str]:
+    yield '['
+    for start in range(0, num_rows, chunk_size):
+        if start:
+            yield encoder.item_separator
+        yield encoder.encode(get_rows(start, start + chunk_size))[1:-1]
+    yield ']'
+
+
+def iterencode_chunked(obj: Any, chunk_size: int = 10000, orient: str = 'records',
+                       encoder: Optional[json.JSONEncoder] = None) -> Iterator[str]:
+    """
+    Encode obj like encoder.encode(obj) (by default with a JSONEncoder), yielding the json document by parts.
+
+    numpy arrays and pandas Series and DataFrames are converted and encoded by chunks of chunk_size rows,
+    so that the temporary python objects never hold more than one chunk.
+    DataFrames are encoded as a list of records (orient='records') or as a dict of columns (orient='columns').
+    """
+    if orient not in ('records', 'columns'):
+        raise ValueError('unknown orient: {!r}'.format(orient))
+    if encoder is None:
+        encoder = JSONEncoder()
+    if encoder.indent is not None:
+        raise ValueError('indent is not supported')
+    kind = _array_kind(obj)
+    if kind == 'array':
+        yield from _iterencode_rows(encoder, len(obj), lambda start, stop: _convert_ndarray(obj[start:stop]),
+                                    chunk_size)
+    elif kind == 'series':
+        rows = getattr(obj, 'iloc', obj)  # positional slicing for Series and Index
+        yield from _iterencode_rows(encoder, len(obj), lambda start, stop: _series_to_list(rows[start:stop]),
+                                    chunk_size)
+    elif kind == 'frame' and orient == 'records':
+        yield from _iterencode_rows(encoder, len(obj), lambda start, stop: _frame_to_records(obj.iloc[start:stop]),
+                                    chunk_size)
+    elif kind == 'frame':
+        yield '{'
+        for i, column in enumerate(obj.columns.tolist()):
+            if i:
+                yield encoder.item_separator
+            yield _encode_key(encoder, column) + encoder.key_separator
+            yield from _iterencode_rows(encoder, len(obj),
+                                        lambda start, stop: _series_to_list(obj.iloc[start:stop, i]), chunk_size)
+        yield '}'
+    else:
+        yield encoder.encode(obj)
+
+
+def _open_compressed(file, mode: str, compression: Optional[str], buffer_size: int):
+    """
+    Open a binary file object for reading or writing, return it and whether it must be closed afterwards.
+
+    file is either a path or a binary file object, which is not closed.
+    """
+    if compression not in (None, 'gzip', 'zstd'):
+        raise ValueError('unknown compression: {!r}'.format(compression))
+    is_path = isinstance(file, (str, pathlib.PurePath))
+    if compression is None:
+        if is_path:
+            return open(file, mode + 'b', buffering=buffer_size), True
+        return file, False
+    if compression == 'gzip':
+        if is_path:
+            return gzip.open(file, mode + 'b'), True
+        return gzip.GzipFile(fileobj=file, mode=mode + 'b'), True
+    try:
+        import zstandard
+    except ImportError:  # pragma: no cover
+        raise ImportError('The zstandard package is required for zstd compression. Please install it yourself.')
+    raw = open(file, mode + 'b', buffering=buffer_size) if is_path else file
+    if mode == 'w':
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=is_path), True
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, closefd=is_path), buffer_size), True
+
+
+class JSONLinesWriter:
+    """
+    Write records (one json document per line) to a JSON Lines file.
+
+    A single JSONEncoder is used for all the records, and the encoded records are written
+    by batches of batch_size through a buffered and optionally compressed ('gzip' or 'zstd') file.
+    file is either a path or a binary file object (which is not closed by the writer).
+    The keyword arguments are passed to the encoder.
+    """
+
+    def __init__(self, file, compression: Optional[str] = None, batch_size: int = 1000,
+                 buffer_size: int = 1 << 20, encoder_cls=None, **encoder_kwargs):
+        if encoder_kwargs.get('indent') is not None:
+            raise ValueError('indent is not supported in JSON Lines')
+        self.encoder = (encoder_cls or JSONEncoder)(**encoder_kwargs)
+        self.batch_size = batch_size
+        self.num_records = 0
+        self._batch = []
+        self._file, self._close_file = _open_compressed(file, 'w', compression, buffer_size)
+
+    def write(self, record: Any) -> None:
+        self._batch.append(self.encoder.encode(record))
+        if len(self._batch) >= self.batch_size:
+            self._write_batch()
+
+    def write_many(self, records: Iterable[Any]) -> None:
+        encode = self.encoder.encode
+        batch = self._batch
+        for record in records:
+            batch.append(encode(record))
+            if len(batch) >= self.batch_size:
+                self._write_batch()
+
+    def write_frame(self, df, chunk_size: int = 10000) -> None:
+        """
+        Write the rows of a pandas DataFrame as records, converting chunk_size rows at a time.
+        """
+        for start in range(0, len(df), chunk_size):
+            self.write_many(_frame_to_records(df.iloc[start:start + chunk_size]))
+
+    def _write_batch(self):
+        if self._batch:
+            self._batch.append('')
+            self._file.write('\n'.join(self._batch).encode('utf-8'))
+            self.num_records += len(self._batch) - 1
+            self._batch.clear()
+
+    def flush(self) -> None:
+        """
+        Write the pending records and flush the file.
+        """
+        self._write_batch()
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file is None:
+            return
+        self.flush()
+        if self._close_file:
+            self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_json_lines(file, compression: Optional[str] = None, use_mmap=False,
+                    buffer_size: int = 1 << 20, **decoder_kwargs) -> Iterator[Any]:
+    """
+    Lazily read the records of a JSON Lines file, one per line, blank lines are skipped.
+
+    file is either a path or a binary file object (which is not closed).
+    With use_mmap=True, an uncompressed file given by its path is memory-mapped instead of read.
+    The keyword arguments (object_hook, object_pairs_hook, parse_float...) are passed to the json.JSONDecoder,
+    see also field_converters_hook().
+    """
+    decode = json.JSONDecoder(**decoder_kwargs).decode
+    if use_mmap:
+        if compression is not None or not isinstance(file, (str, pathlib.PurePath)):
+            raise ValueError('use_mmap requires the path of an uncompressed file')
+        with open(file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for line in iter(mm.readline, b''):
+                    if not line.isspace():
+                        yield decode(line.decode('utf-8'))
+        return
+    f, close_file = _open_compressed(file, 'r', compression, buffer_size)
+    try:
+        for line in f:
+            if not line.isspace():
+                yield decode(line.decode('utf-8'))
+    finally:
+        if close_file:
+            f.close()
+
+
+def field_converters_hook(converters: Dict[str, Callable[[Any], Any]]) -> Callable[[Dict], Dict]:
+    """
+    Return an object_hook for json decoding, which converts the values of the given keys, for example
+    {'date': datetime.date.fromisoformat} to decode the dates encoded by JSONEncoder.
+    """
+    def object_hook(obj):
+        for key in converters.keys() & obj.keys():
+            obj[key] = converters[key](obj[key])
+        return obj
+    return object_hook
+
+
+_encode_basestring = json.encoder.encode_basestring
+_canonical_default_encoder = JSONEncoder()
+_uuid_probe = uuid.UUID(int=0)
+_compact_encoders = {
+    sort_keys: JSONEncoder(separators=(',', ':'), ensure_ascii=False, sort_keys=sort_keys)
+    for sort_keys in (False, True)
+}
+# floats in exponent notation in the orjson output (they are written differently by the stdlib),
+# this can also match inside strings, which only means that the stdlib encoder is used
+_orjson_exponent_re = re.compile(rb'e-?\d+(?:[,\]}]|$)')
+
+
+def _has_non_finite_float(obj: Any, default: Callable[[Any], Any]) -> bool:
+    """
+    Return True if obj contains NaN or infinities, looking into the values given by default()
+    for the objects which orjson doesn't serialize natively, like orjson does.
+    """
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if isinstance(o, float):
+            if not math.isfinite(o):
+                return True
+        elif isinstance(o, (str, int, uuid.UUID)) or o is None:
+            continue
+        elif isinstance(o, dict):
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple)):
+            stack.extend(o)
+        elif isinstance(o, enum.Enum):
+            stack.append(o.value)
+        else:
+            stack.append(default(o))
+    return False
+
+
+def _orjson_output_may_differ(result: bytes, obj: Any, default: Callable[[Any], Any]) -> bool:
+    # floats below 1e-4 aren't written in exponent notation by orjson,
+    # and NaN and infinities are written as null, which is only looked for when there is a null
+    if b'0.0000' in result or _orjson_exponent_re.search(result) is not None:
+        return True
+    return b'null' in result and _has_non_finite_float(obj, default)
+
+
+def dumps(obj: Any, sort_keys=False, backend: Optional[str] = None) -> str:
+    """
+    Serialize obj to a compact json string, exactly like
+    json.dumps(obj, cls=JSONEncoder, separators=(',', ':'), ensure_ascii=False, sort_keys=sort_keys).
+
+    The orjson package is used when it is installed (backend=None) or when backend='orjson',
+    with the conversions of JSONEncoder. When its output could differ from the stdlib output
+    (floats written differently, NaN or infinities, integers which don't fit in 64 bits, non-str keys...),
+    the stdlib encoder is used instead (backend='stdlib').
+    orjson serializes UUIDs and enums natively: the stdlib encoder is used as well when a converter
+    is registered for UUID, but enums are always serialized as their value with orjson.
+    """
+    if backend is None:
+        backend = 'stdlib' if orjson is None else 'orjson'
+    if backend == 'orjson' and _compact_encoders[sort_keys].default(_uuid_probe) != str(_uuid_probe):
+        backend = 'stdlib'
+    if backend == 'orjson':
+        if orjson is None:
+            raise ImportError('The orjson package is required for the orjson backend. Please install it yourself.')
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        default = _compact_encoders[sort_keys].default
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            result = orjson.dumps(obj, default=default, option=option)
+        except orjson.JSONEncodeError:
             pass
-        # handle Path objects
-        if isinstance(o, pathlib.Path):
-            return str(o).replace('\\', '/')
-        # handle UUID objects
-        if isinstance(o, uuid.UUID):
-            return str(o)
-        if isinstance(o, (datetime.datetime, datetime.time, datetime.date)):
-            return o.isoformat()
-        if isinstance(o, datetime.timedelta):
-            return o.total_seconds()
-        if isinstance(o, (complex, decimal.Decimal)):
-            return str(o)
-        # Let the base class default method raise the TypeError
-        return json.JSONEncoder.default(self, o)
+        else:
+            if not _orjson_output_may_differ(result, obj, default):
+                return result.decode('utf-8')
+    elif backend != 'stdlib':
+        raise ValueError('unknown backend: {!r}'.format(backend))
+    return _compact_encoders[sort_keys].encode(obj)
+
+
+def dump(obj: Any, fp, sort_keys=False, backend: Optional[str] = None) -> None:
+    """
+    Serialize obj to a compact json document written to the text file object fp, see dumps().
+    """
+    fp.write(dumps(obj, sort_keys=sort_keys, backend=backend))
+
+
+def _canonical_float(f: float) -> str:
+    """
+    Format a float like the ECMAScript Number.prototype.toString(), as required by JCS (RFC 8785).
+    """
+    if math.isnan(f) or math.isinf(f):
+        raise ValueError('NaN and infinities are not allowed in canonical json')
+    if f == 0:
+        return '0'
+    if abs(f) < 2 ** 53 and f.is_integer():
+        return '%d' % f
+    sign = '-' if f < 0 else ''
+    # repr() gives the shortest digits which round-trip, as required
+    mantissa, _, exponent = repr(abs(f)).partition('e')
+    int_part, _, frac_part = mantissa.partition('.')
+    all_digits = int_part + frac_part
+    num_leading_zeros = len(all_digits) - len(all_digits.lstrip('0'))
+    digits = all_digits[num_leading_zeros:].rstrip('0')
+    # value = 0.<digits> * 10 ** n
+    n = len(int_part) - num_leading_zeros + int(exponent or 0)
+    k = len(digits)
+    if k <= n <= 21:
+        return sign + digits + '0' * (n - k)
+    if 0 < n <= 21:
+        return sign + digits[:n] + '.' + digits[n:]
+    if -6 < n <= 0:
+        return sign + '0.' + '0' * -n + digits
+    e = n - 1
+    return '{}{}{}e{}{}'.format(sign, digits[0], '.' + digits[1:] if k > 1 else '', '+' if e > 0 else '-', abs(e))
+
+
+def _canonical_key(key) -> str:
+    if isinstance(key, str):
+        return key
+    if key is True:
+        return 'true'
+    if key is False:
+        return 'false'
+    if key is None:
+        return 'null'
+    if isinstance(key, int):
+        return int.__repr__(key)
+    if isinstance(key, float):
+        return _canonical_float(key)
+    raise TypeError('keys must be str, int, float, bool or None, not {}'.format(type(key).__name__))
+
+
+def _utf16_sort_key(item):
+    return item[0].encode('utf-16-be')
+
+
+def _canonical_items(obj: dict) -> list:
+    """
+    Return the (key, value) pairs of a dict with string keys, sorted by the UTF-16 code units of the keys.
+    """
+    if all(type(key) is str for key in obj):
+        is_ascii = all(map(str.isascii, obj))
+        items = list(obj.items())
+    else:
+        items = [(_canonical_key(key), value) for key, value in obj.items()]
+        if len({key for key, _ in items}) != len(items):
+            raise ValueError('duplicate keys after conversion to strings')
+        is_ascii = all(key.isascii() for key, _ in items)
+    if is_ascii:
+        # the order of the code points is the same as the order of the UTF-16 code units
+        # (the keys are unique so the values are never compared)
+        items.sort()
+    else:
+        items.sort(key=_utf16_sort_key)
+    return items
+
+
+# kinds of the entries of the stack of _canonical_encode()
+_ENCODE_VALUE, _WRITE_TEXT, _RELEASE_MARKER = range(3)
+
+
+def _canonical_encode(obj, default: Callable[[Any], Any], markers: Dict[int, Any]) -> str:
+    """
+    Encode obj to canonical json with an explicit stack instead of recursion, so that it works at any depth.
+    """
+    parts = []
+    stack = [(_ENCODE_VALUE, obj)]
+    while stack:
+        kind, obj = stack.pop()
+        if kind == _WRITE_TEXT:
+            parts.append(obj)
+            continue
+        if kind == _RELEASE_MARKER:
+            del markers[obj]
+            continue
+        obj_type = type(obj)
+        if obj_type is str:
+            parts.append(_encode_basestring(obj))
+        elif obj_type is int:
+            parts.append(int.__repr__(obj))
+        elif obj_type is float:
+            parts.append(_canonical_float(obj))
+        elif obj is None:
+            parts.append('null')
+        elif obj is True:
+            parts.append('true')
+        elif obj is False:
+            parts.append('false')
+        elif isinstance(obj, str):
+            parts.append(_encode_basestring(obj))
+        elif isinstance(obj, int):
+            parts.append(int.__repr__(obj))
+        elif isinstance(obj, float):
+            parts.append(_canonical_float(obj))
+        else:
+            marker = id(obj)
+            if marker in markers:
+                raise ValueError('Circular reference detected')
+            markers[marker] = obj
+            # pushed in reverse order of writing
+            stack.append((_RELEASE_MARKER, marker))
+            if isinstance(obj, dict):
+                stack.append((_WRITE_TEXT, '}'))
+                items = _canonical_items(obj)
+                for i in range(len(items) - 1, -1, -1):
+                    key, value = items[i]
+                    stack.append((_ENCODE_VALUE, value))
+                    stack.append((_WRITE_TEXT, (',' if i else '') + _encode_basestring(key) + ':'))
+                parts.append('{')
+            elif isinstance(obj, (list, tuple)):
+                stack.append((_WRITE_TEXT, ']'))
+                for i in range(len(obj) - 1, -1, -1):
+                    stack.append((_ENCODE_VALUE, obj[i]))
+                    if i:
+                        stack.append((_WRITE_TEXT, ','))
+                parts.append('[')
+            else:
+                stack.append((_ENCODE_VALUE, default(obj)))
+    return ''.join(parts)
+
+
+def canonical_dumps(obj: Any, as_bytes=False, encoder: Optional[JSONEncoder] = None) -> Union[str, bytes]:
+    """
+    Serialize obj to canonical json, following the JSON Canonicalization Scheme (JCS, RFC 8785):
+
+    * no whitespace, keys sorted by their UTF-16 code units, and strings escaped minimally
+      (only quotation mark, backslash and control characters, with lowercase hex digits)
+    * floats formatted like ECMAScript (shortest round-trip digits, e.g. 1.0 -> 1, 1e21 -> 1e+21),
+      NaN and infinities raise ValueError
+
+    Extensions to JCS: integers are written exactly (even above 2**53), keys which are int, float, bool or None
+    are converted to strings like the values (duplicates raise ValueError), and the types supported
+    by JSONEncoder (or by the given encoder) are converted with its default() method.
+
+    With as_bytes=True, the UTF-8 encoded document is returned (e.g. for hashing): this is only
+    a shortcut for canonical_dumps(obj).encode('utf-8'), the document is still built as a str first.
+    """
+    result = _canonical_encode(obj, (encoder or _canonical_default_encoder).default, {})
+    if as_bytes:
+        return result.encode('utf-8')
+    return result
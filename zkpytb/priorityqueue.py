@@ -6,23 +6,69 @@ Author: Marc Gallet
 Date: 2018-01
 """
 
+import asyncio
+import collections
 import heapq
 import itertools
+import mmap
+import multiprocessing
+import operator
+import os
+import pickle
+import threading
+import time
 
 
 class EmptyQueueError(Exception):
     pass
 
 
+class _ReverseOrder:
+    """Wrapper around a heap entry inverting its ordering, to make a max-heap with heapq"""
+    __slots__ = ('entry',)
+
+    def __init__(self, entry):
+        self.entry = entry
+
+    def __lt__(self, other):
+        return other.entry < self.entry
+
+
 class PriorityQueue:
-    """Based on https://docs.python.org/3/library/heapq.html#priority-queue-implementation-notes"""
+    """
+    Based on https://docs.python.org/3/library/heapq.html#priority-queue-implementation-notes
 
-    def __init__(self, name=''):
+    Unlike in the recipe, entries are compact (priority, count, task) tuples instead of
+    4-element lists with a "removed" flag: an entry in the heap is removed when it is no
+    longer the one referenced for its task in entry_finder.
+
+    If maxsize is given, the queue holds at most maxsize tasks (e.g. to keep the top-K
+    of a stream). When the queue is full, adding a new task evicts the task with the largest
+    priority (evict='largest', keeping the smallest priorities) or the smallest priority
+    (evict='smallest', keeping the largest priorities), unless the new task would itself be
+    the one evicted, in which case it is rejected. The evicted or rejected task is returned
+    by add_task() and passed with its priority to the on_evict callback if any.
+    """
+
+    # don't bother compacting heaps smaller than this, heappop will clean them up soon enough
+    compact_min_size = 64
+
+    def __init__(self, name='', compact_threshold=0.5, maxsize=None, evict='largest', on_evict=None):
+        if maxsize is not None and maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        if evict not in ('largest', 'smallest'):
+            raise ValueError("evict must be either 'largest' or 'smallest'")
         self.name = name
-        self.pq = []                         # list of entries arranged in a heap
-        self.entry_finder = {}               # mapping of tasks to entries
+        self.pq = []                         # list of (priority, count, task) entries arranged in a heap
+        self.entry_finder = {}               # mapping of tasks to their live entry
         self.counter = itertools.count()     # unique sequence count
         self.num_tasks = 0                   # track the number of tasks in the queue
+        self.num_removed = 0                 # track the number of removed entries still in the heap
+        self.compact_threshold = compact_threshold  # max fraction of removed entries before compaction
+        self.maxsize = maxsize               # max number of tasks in the queue, None means unbounded
+        self.evict = evict                   # which end of the queue is evicted when it is full
+        self.on_evict = on_evict             # called with (task, priority) for each evicted task
+        self.worst_pq = []                   # max-heap of _ReverseOrder(entry) when evicting the largest
 
     def __len__(self):
         return self.num_tasks
@@ -36,33 +82,1022 @@ class PriorityQueue:
         except EmptyQueueError:
             raise StopIteration
 
+    def __contains__(self, task):
+        return task in self.entry_finder
+
     @property
     def empty(self):
         return self.num_tasks == 0
 
+    def peek(self):
+        'Return the lowest priority task without removing it. Raise EmptyQueueError if empty.'
+        entry = self._peek_entry()
+        if entry is None:
+            raise EmptyQueueError('peek from an empty priority queue')
+        return entry[2]
+
+    def priority_of(self, task):
+        'Return the priority of a task in the queue. Raise KeyError if not found.'
+        return self.entry_finder[task][0]
+
     def add_task(self, task, priority=0):
-        'Add a new task or update the priority of an existing task'
+        'Add a new task or update the priority of an existing task. Return the evicted task if any.'
         if task in self.entry_finder:
             self.remove_task(task)
-        count = next(self.counter)
-        removed = False
-        entry = [priority, count, task, removed]
+        evicted = None
+        if self.maxsize is not None and self.num_tasks >= self.maxsize:
+            worst = self._worst_entry()
+            if self.evict == 'largest':
+                beats_worst = priority < worst[0]
+            else:
+                beats_worst = priority > worst[0]
+            if not beats_worst:
+                # can't beat the current worst task, reject the new one right away
+                if self.on_evict is not None:
+                    self.on_evict(task, priority)
+                return task
+            evicted = worst[2]
+            self.remove_task(evicted)
+            if self.on_evict is not None:
+                self.on_evict(evicted, worst[0])
+        entry = (priority, next(self.counter), task)
         self.entry_finder[task] = entry
         heapq.heappush(self.pq, entry)
         self.num_tasks += 1
+        if self.maxsize is not None and self.evict == 'largest':
+            heapq.heappush(self.worst_pq, _ReverseOrder(entry))
+            if len(self.worst_pq) > 2 * self.maxsize + self.compact_min_size:
+                self._rebuild_worst_pq()
+        return evicted
 
     def remove_task(self, task):
         'Mark an existing task as REMOVED. Raise KeyError if not found.'
-        entry = self.entry_finder.pop(task)
-        entry[-1] = True  # mark the element as removed
+        del self.entry_finder[task]  # its entry in the heap is now a removed entry
         self.num_tasks -= 1
+        self.num_removed += 1
+        if (self.compact_threshold is not None
+                and len(self.pq) >= self.compact_min_size
+                and self.num_removed > self.compact_threshold * len(self.pq)):
+            self.compact()
 
-    def pop_task(self):
-        'Remove and return the lowest priority task. Raise KeyError if empty.'
+    def compact(self):
+        'Rebuild the heap without the removed entries.'
+        self.pq = list(self.entry_finder.values())
+        heapq.heapify(self.pq)
+        self.num_removed = 0
+        if self.worst_pq:
+            self._rebuild_worst_pq()
+
+    def _rebuild_worst_pq(self):
+        self.worst_pq = [_ReverseOrder(entry) for entry in self.entry_finder.values()]
+        heapq.heapify(self.worst_pq)
+
+    def _worst_entry(self):
+        'Return the entry of the task that would be evicted first, or None if empty.'
+        if self.evict == 'smallest':
+            return self._peek_entry()
+        worst_pq = self.worst_pq
+        entry_finder = self.entry_finder
+        while worst_pq:
+            entry = worst_pq[0].entry
+            if entry_finder.get(entry[2]) is entry:
+                return entry
+            heapq.heappop(worst_pq)
+        return None
+
+    def add_tasks(self, tasks):
+        'Add new tasks or update existing ones from an iterable of (task, priority) pairs'
+        if self.maxsize is not None:
+            for task, priority in tasks:
+                self.add_task(task, priority)
+            return
+        entry_finder = self.entry_finder
+        counter = self.counter
+        new_entries = {}
+        for task, priority in tasks:
+            if task in new_entries:
+                del new_entries[task]
+            elif task in entry_finder:
+                self.remove_task(task)
+            new_entries[task] = (priority, next(counter), task)
+        entries = list(new_entries.values())
+        entry_finder.update(new_entries)
+        self.num_tasks += len(entries)
+        # heapify is O(n) for the whole heap while pushing is O(log n) per entry,
+        # only rebuild the heap when that's cheaper
+        if len(entries) * max(1, len(self.pq).bit_length()) >= len(self.pq):
+            self.pq.extend(entries)
+            heapq.heapify(self.pq)
+        else:
+            for entry in entries:
+                heapq.heappush(self.pq, entry)
+
+    def _peek_entry(self):
+        'Return the entry of the lowest priority task without removing it, or None if empty.'
+        pq = self.pq
+        entry_finder = self.entry_finder
+        while pq:
+            entry = pq[0]
+            if entry_finder.get(entry[2]) is entry:
+                return entry
+            heapq.heappop(pq)
+            self.num_removed -= 1
+        return None
+
+    def _pop_entry(self):
+        'Remove and return the entry of the lowest priority task. Raise EmptyQueueError if empty.'
+        entry_finder = self.entry_finder
         while self.pq:
-            priority, count, task, removed = heapq.heappop(self.pq)
-            if not removed:
-                del self.entry_finder[task]
+            entry = heapq.heappop(self.pq)
+            live_entry = entry_finder.pop(entry[2], None)
+            if live_entry is entry:
                 self.num_tasks -= 1
-                return task
+                return entry
+            if live_entry is not None:
+                # the task was added again after this entry was removed, keep the new entry
+                entry_finder[entry[2]] = live_entry
+            self.num_removed -= 1
         raise EmptyQueueError('pop from an empty priority queue')
+
+    def pop_task(self):
+        'Remove and return the lowest priority task. Raise EmptyQueueError if empty.'
+        return self._pop_entry()[2]
+
+    def pop_many(self, k):
+        'Remove and return a list of (at most) the k lowest priority tasks.'
+        tasks = []
+        while len(tasks) < k and self.num_tasks:
+            tasks.append(self._pop_entry()[2])
+        return tasks
+
+    def pop_until(self, priority):
+        'Remove and return the list of all tasks with a priority lower or equal to the given one.'
+        tasks = []
+        entry = self._peek_entry()
+        while entry is not None and entry[0] <= priority:
+            tasks.append(self._pop_entry()[2])
+            entry = self._peek_entry()
+        return tasks
+
+
+class InstrumentedPriorityQueue(PriorityQueue):
+    """
+    PriorityQueue which collects statistics about its usage, see stats().
+
+    The instrumentation lives in this subclass only, so PriorityQueue itself doesn't pay
+    anything for it. The time each task waited in the queue is recorded, keyed by its
+    insertion count, into a histogram with power of 2 buckets in microseconds.
+    """
+
+    def __init__(self, *args, clock=time.perf_counter, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.clock = clock
+        self.counters = dict.fromkeys(
+            ['adds', 'updates', 'removes', 'evictions', 'pops', 'skipped_removed', 'compactions'], 0
+        )
+        self.latency_histogram = collections.Counter()  # upper bound in seconds -> number of popped tasks
+        self.add_times = {}                  # mapping of the count of live entries to the time they were added
+        self._in_add = False                 # removals done by add_task() are updates/evictions, not removes
+
+    def _record_add_times(self, tasks):
+        now = self.clock()
+        entry_finder = self.entry_finder
+        for task in tasks:
+            entry = entry_finder.get(task)
+            if entry is not None:
+                self.add_times[entry[1]] = now
+
+    def add_task(self, task, priority=0):
+        'Add a new task or update the priority of an existing task. Return the evicted task if any.'
+        self.counters['updates' if task in self.entry_finder else 'adds'] += 1
+        self._in_add = True
+        try:
+            evicted = super().add_task(task, priority)
+        finally:
+            self._in_add = False
+        if evicted is not None:
+            self.counters['evictions'] += 1
+        self._record_add_times([task])
+        return evicted
+
+    def add_tasks(self, tasks):
+        'Add new tasks or update existing ones from an iterable of (task, priority) pairs'
+        if self.maxsize is not None:
+            super().add_tasks(tasks)  # goes through add_task()
+            return
+        tasks = list(tasks)
+        num_tasks = self.num_tasks
+        self._in_add = True
+        try:
+            super().add_tasks(tasks)
+        finally:
+            self._in_add = False
+        num_added = self.num_tasks - num_tasks
+        self.counters['adds'] += num_added
+        self.counters['updates'] += len(tasks) - num_added
+        self._record_add_times(task for task, _ in tasks)
+
+    def remove_task(self, task):
+        'Mark an existing task as REMOVED. Raise KeyError if not found.'
+        count = self.entry_finder[task][1]
+        super().remove_task(task)
+        self.add_times.pop(count, None)
+        if not self._in_add:
+            self.counters['removes'] += 1
+
+    def compact(self):
+        'Rebuild the heap without the removed entries.'
+        super().compact()
+        self.counters['compactions'] += 1
+
+    def _peek_entry(self):
+        num_removed = self.num_removed
+        entry = super()._peek_entry()
+        self.counters['skipped_removed'] += num_removed - self.num_removed
+        return entry
+
+    def _pop_entry(self):
+        num_removed = self.num_removed
+        try:
+            entry = super()._pop_entry()
+        finally:
+            self.counters['skipped_removed'] += num_removed - self.num_removed
+        self.counters['pops'] += 1
+        added = self.add_times.pop(entry[1], None)
+        if added is not None:
+            latency_us = int((self.clock() - added) * 1e6)
+            self.latency_histogram[(1 << latency_us.bit_length()) / 1e6] += 1
+        return entry
+
+    def stats(self):
+        'Return a snapshot of the statistics of the queue.'
+        return {
+            'num_tasks': self.num_tasks,
+            'num_removed': self.num_removed,
+            'heap_size': len(self.pq),
+            'heap_depth': len(self.pq).bit_length(),
+            **self.counters,
+            'latency_histogram': dict(sorted(self.latency_histogram.items())),
+        }
+
+
+class IndexedPriorityQueue(PriorityQueue):
+    """
+    Same API as PriorityQueue but backed by an indexed binary heap.
+
+    Each entry keeps its position in the heap, so that updating the priority of a task
+    moves its entry in place (true decrease-key/increase-key) and removing a task really
+    removes its entry, both in O(log n). The heap never contains removed entries.
+    """
+
+    def __init__(self, name=''):
+        self.name = name
+        self.pq = []                         # list of entries [priority, count, task, position] in a heap
+        self.entry_finder = {}               # mapping of tasks to entries
+        self.counter = itertools.count()     # unique sequence count
+        self.num_tasks = 0                   # track the number of tasks in the queue
+        self.num_removed = 0                 # always 0, kept for compatibility with PriorityQueue
+        self.compact_threshold = None
+
+    def add_task(self, task, priority=0):
+        'Add a new task or update the priority of an existing task'
+        entry = self.entry_finder.get(task)
+        if entry is None:
+            entry = [priority, next(self.counter), task, len(self.pq)]
+            self.entry_finder[task] = entry
+            self.pq.append(entry)
+            self.num_tasks += 1
+            self._sift_up(entry[3])
+        else:
+            old_key = entry[:2]
+            entry[0] = priority
+            entry[1] = next(self.counter)
+            if entry[:2] < old_key:
+                self._sift_up(entry[3])
+            else:
+                self._sift_down(entry[3])
+
+    def add_tasks(self, tasks):
+        'Add new tasks or update existing ones from an iterable of (task, priority) pairs'
+        if self.pq:
+            for task, priority in tasks:
+                self.add_task(task, priority)
+            return
+        # empty heap: build all the entries and heapify them at once
+        entries = {}
+        for task, priority in tasks:
+            entries.pop(task, None)
+            entries[task] = [priority, next(self.counter), task, 0]
+        self.pq = list(entries.values())
+        heapq.heapify(self.pq)
+        for pos, entry in enumerate(self.pq):
+            entry[3] = pos
+        self.entry_finder = entries
+        self.num_tasks = len(entries)
+
+    def remove_task(self, task):
+        'Remove an existing task. Raise KeyError if not found.'
+        entry = self.entry_finder.pop(task)
+        self._remove_at(entry[3])
+        self.num_tasks -= 1
+
+    def compact(self):
+        'Nothing to do, the heap never contains removed entries.'
+
+    def _peek_entry(self):
+        return self.pq[0] if self.pq else None
+
+    def _pop_entry(self):
+        if not self.pq:
+            raise EmptyQueueError('pop from an empty priority queue')
+        entry = self.pq[0]
+        del self.entry_finder[entry[2]]
+        self._remove_at(0)
+        self.num_tasks -= 1
+        return entry
+
+    def _remove_at(self, pos):
+        last = self.pq.pop()
+        if pos < len(self.pq):
+            self.pq[pos] = last
+            last[3] = pos
+            self._sift_up(pos)
+            self._sift_down(last[3])
+
+    def _sift_up(self, pos):
+        'Move the entry at pos towards the root until the heap invariant is restored.'
+        heap = self.pq
+        entry = heap[pos]
+        while pos > 0:
+            parentpos = (pos - 1) >> 1
+            parent = heap[parentpos]
+            if entry < parent:
+                heap[pos] = parent
+                parent[3] = pos
+                pos = parentpos
+            else:
+                break
+        heap[pos] = entry
+        entry[3] = pos
+
+    def _sift_down(self, pos):
+        'Move the entry at pos towards the leaves until the heap invariant is restored.'
+        heap = self.pq
+        endpos = len(heap)
+        entry = heap[pos]
+        childpos = 2 * pos + 1
+        while childpos < endpos:
+            rightpos = childpos + 1
+            if rightpos < endpos and heap[rightpos] < heap[childpos]:
+                childpos = rightpos
+            child = heap[childpos]
+            if child < entry:
+                heap[pos] = child
+                child[3] = pos
+                pos = childpos
+                childpos = 2 * pos + 1
+            else:
+                break
+        heap[pos] = entry
+        entry[3] = pos
+
+
+class BucketPriorityQueue(PriorityQueue):
+    """
+    Same API as PriorityQueue for small integer priorities in range(num_levels).
+
+    Each priority level is a FIFO of (priority, count, task) entries and a bitmap tracks
+    the non-empty levels, so that adding and popping tasks is O(1) amortised instead of
+    O(log n). Tasks with the same priority are popped in insertion order, like in PriorityQueue.
+    """
+
+    def __init__(self, name='', num_levels=256, compact_threshold=0.5):
+        self.name = name
+        self.num_levels = num_levels
+        self.buckets = [collections.deque() for _ in range(num_levels)]  # one FIFO of entries per level
+        self.nonempty = 0                    # bitmap of the levels with a non-empty FIFO
+        self.entry_finder = {}               # mapping of tasks to their live entry
+        self.counter = itertools.count()     # unique sequence count
+        self.num_tasks = 0                   # track the number of tasks in the queue
+        self.num_removed = 0                 # track the number of removed entries still in the FIFOs
+        self.compact_threshold = compact_threshold  # max fraction of removed entries before compaction
+
+    def add_task(self, task, priority=0):
+        'Add a new task or update the priority of an existing task'
+        priority = operator.index(priority)  # raise TypeError for non-integer priorities before any change
+        if not 0 <= priority < self.num_levels:
+            raise ValueError('priority must be in range({})'.format(self.num_levels))
+        if task in self.entry_finder:
+            self.remove_task(task)
+        entry = (priority, next(self.counter), task)
+        self.entry_finder[task] = entry
+        self.buckets[priority].append(entry)
+        self.nonempty |= 1 << priority
+        self.num_tasks += 1
+
+    def add_tasks(self, tasks):
+        'Add new tasks or update existing ones from an iterable of (task, priority) pairs'
+        for task, priority in tasks:
+            self.add_task(task, priority)
+
+    def remove_task(self, task):
+        'Mark an existing task as REMOVED. Raise KeyError if not found.'
+        del self.entry_finder[task]  # its entry in the FIFO is now a removed entry
+        self.num_tasks -= 1
+        self.num_removed += 1
+        num_entries = self.num_tasks + self.num_removed
+        if (self.compact_threshold is not None
+                and num_entries >= self.compact_min_size
+                and self.num_removed > self.compact_threshold * num_entries):
+            self.compact()
+
+    def compact(self):
+        'Rebuild the FIFOs without the removed entries.'
+        entry_finder = self.entry_finder
+        bits = self.nonempty
+        while bits:
+            level = (bits & -bits).bit_length() - 1
+            bits &= bits - 1
+            bucket = self.buckets[level] = collections.deque(
+                entry for entry in self.buckets[level] if entry_finder.get(entry[2]) is entry
+            )
+            if not bucket:
+                self.nonempty &= ~(1 << level)
+        self.num_removed = 0
+
+    def _peek_entry(self):
+        'Return the entry of the lowest priority task without removing it, or None if empty.'
+        entry_finder = self.entry_finder
+        while self.nonempty:
+            level = (self.nonempty & -self.nonempty).bit_length() - 1
+            bucket = self.buckets[level]
+            while bucket:
+                entry = bucket[0]
+                if entry_finder.get(entry[2]) is entry:
+                    return entry
+                bucket.popleft()
+                self.num_removed -= 1
+            self.nonempty &= ~(1 << level)
+        return None
+
+    def _pop_entry(self):
+        'Remove and return the entry of the lowest priority task. Raise EmptyQueueError if empty.'
+        entry = self._peek_entry()
+        if entry is None:
+            raise EmptyQueueError('pop from an empty priority queue')
+        bucket = self.buckets[entry[0]]
+        bucket.popleft()
+        if not bucket:
+            self.nonempty &= ~(1 << entry[0])
+        del self.entry_finder[entry[2]]
+        self.num_tasks -= 1
+        return entry
+
+
+class ConcurrentPriorityQueue(PriorityQueue):
+    """
+    Thread-safe PriorityQueue where pop_task() can block until a task is available.
+
+    Iterating over the queue never blocks and stops as soon as the queue is empty.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.not_empty = threading.Condition()
+
+    def __next__(self):
+        try:
+            return self.pop_task(block=False)
+        except EmptyQueueError:
+            raise StopIteration
+
+    def add_task(self, task, priority=0):
+        'Add a new task or update the priority of an existing task'
+        with self.not_empty:
+            evicted = super().add_task(task, priority)
+            self.not_empty.notify()
+            return evicted
+
+    def add_tasks(self, tasks):
+        'Add new tasks or update existing ones from an iterable of (task, priority) pairs'
+        with self.not_empty:
+            super().add_tasks(tasks)
+            self.not_empty.notify(self.num_tasks)
+
+    def remove_task(self, task):
+        'Mark an existing task as REMOVED. Raise KeyError if not found.'
+        with self.not_empty:
+            super().remove_task(task)
+
+    def compact(self):
+        with self.not_empty:
+            super().compact()
+
+    def peek(self):
+        with self.not_empty:
+            return super().peek()
+
+    def pop_task(self, block=True, timeout=None):
+        """
+        Remove and return the lowest priority task.
+
+        If block is true, wait at most timeout seconds (forever if timeout is None)
+        for a task to be available. Raise EmptyQueueError if no task is available.
+        """
+        with self.not_empty:
+            if block and not self.not_empty.wait_for(lambda: self.num_tasks, timeout):
+                raise EmptyQueueError('pop from an empty priority queue (timed out)')
+            return self._pop_entry()[2]
+
+    def pop_many(self, k):
+        with self.not_empty:
+            return super().pop_many(k)
+
+    def pop_until(self, priority):
+        with self.not_empty:
+            return super().pop_until(priority)
+
+
+class AsyncPriorityQueue(PriorityQueue):
+    """
+    PriorityQueue for asyncio where pop_task() is a coroutine waiting until a task is available.
+
+    Like asyncio.Queue it is not thread-safe, all calls must be made from the same event loop.
+    Iterating over the queue never waits and stops as soon as the queue is empty.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._getters = collections.deque()  # futures of the coroutines waiting for a task
+
+    def __next__(self):
+        try:
+            return self.pop_task_nowait()
+        except EmptyQueueError:
+            raise StopIteration
+
+    def _wakeup_next(self):
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+    def add_task(self, task, priority=0):
+        'Add a new task or update the priority of an existing task'
+        evicted = super().add_task(task, priority)
+        self._wakeup_next()
+        return evicted
+
+    def add_tasks(self, tasks):
+        'Add new tasks or update existing ones from an iterable of (task, priority) pairs'
+        super().add_tasks(tasks)
+        for _ in range(min(self.num_tasks, len(self._getters))):
+            self._wakeup_next()
+
+    def pop_task_nowait(self):
+        'Remove and return the lowest priority task. Raise EmptyQueueError if empty.'
+        return self._pop_entry()[2]
+
+    async def pop_task(self, timeout=None):
+        """
+        Remove and return the lowest priority task, waiting until one is available.
+
+        If timeout is not None, raise EmptyQueueError if no task is available after timeout seconds.
+        """
+        if timeout is not None:
+            try:
+                return await asyncio.wait_for(self.pop_task(), timeout)
+            except asyncio.TimeoutError:
+                raise EmptyQueueError('pop from an empty priority queue (timed out)')
+        while self.empty:
+            getter = asyncio.get_running_loop().create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except:  # noqa: E722
+                getter.cancel()  # just in case getter is not done yet
+                try:
+                    self._getters.remove(getter)
+                except ValueError:
+                    pass
+                if not self.empty and not getter.cancelled():
+                    # we were woken up but won't take the task, pass it on
+                    self._wakeup_next()
+                raise
+        return self._pop_entry()[2]
+
+
+class PersistentPriorityQueue(PriorityQueue):
+    """
+    PriorityQueue persisted on disk, which survives restarts.
+
+    Every change (add, remove, pop) is appended to a log file at path. Every
+    checkpoint_interval changes, and when the queue is closed, a checkpoint with the live
+    tasks is written to path + '.checkpoint' and the log is started over. Opening an existing
+    path loads the last checkpoint and replays the log (read through mmap) on top of it.
+
+    Each change is flushed to the OS, so that it survives the process being killed. With
+    fsync=True, it is also fsync'ed to survive a power loss, at a much higher cost.
+
+    Tasks and priorities must be picklable.
+    """
+
+    def __init__(self, path, name='', compact_threshold=0.5, checkpoint_interval=100000, fsync=False):
+        super().__init__(name=name, compact_threshold=compact_threshold)
+        self.path = os.fspath(path)
+        self.checkpoint_path = self.path + '.checkpoint'
+        self.checkpoint_interval = checkpoint_interval
+        self.fsync = fsync
+        self.generation = 0                  # incremented at each checkpoint, to match a log with its checkpoint
+        self.num_logged = 0                  # number of changes in the log since the last checkpoint
+        self._log_file = None
+        self._log_suspended = 0              # > 0 while applying changes which must not be logged
+        self._load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _load(self):
+        self._log_suspended += 1
+        try:
+            if os.path.exists(self.checkpoint_path):
+                with open(self.checkpoint_path, 'rb') as f:
+                    checkpoint = pickle.load(f)
+                self.generation = checkpoint['generation']
+                self.pq = checkpoint['entries']
+                self.entry_finder = {entry[2]: entry for entry in self.pq}
+                self.num_tasks = len(self.pq)
+                self.counter = itertools.count(checkpoint['count'])
+            log_end = self._replay_log()
+        finally:
+            self._log_suspended -= 1
+        self._log_file = open(self.path, 'ab')
+        if log_end is None:
+            self._start_log()
+        else:
+            # drop the incomplete record that a crash may have left at the end of the log
+            self._log_file.truncate(log_end)
+
+    def _replay_log(self):
+        'Apply the changes from the log. Return the offset of the end of the last valid record, or None.'
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return None
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            unpickler = pickle.Unpickler(mm)
+            try:
+                header = unpickler.load()
+            except Exception:
+                return None
+            if header != ('log', self.generation):
+                # log of a previous generation, already included in the checkpoint
+                return None
+            log_end = mm.tell()
+            while True:
+                try:
+                    op, args = unpickler.load()
+                except Exception:
+                    break
+                if op == 'add':
+                    self.add_task(*args)
+                elif op == 'add_many':
+                    self.add_tasks(args)
+                else:
+                    self.remove_task(args)
+                self.num_logged += 1
+                log_end = mm.tell()
+        return log_end
+
+    def _start_log(self):
+        self._log_file.truncate(0)
+        pickle.dump(('log', self.generation), self._log_file, pickle.HIGHEST_PROTOCOL)
+        self._flush()
+        self.num_logged = 0
+
+    def _flush(self):
+        self._log_file.flush()
+        if self.fsync:
+            os.fsync(self._log_file.fileno())
+
+    def _log(self, op, args):
+        if self._log_suspended:
+            return
+        pickle.dump((op, args), self._log_file, pickle.HIGHEST_PROTOCOL)
+        self._flush()
+        self.num_logged += 1
+        if self.checkpoint_interval is not None and self.num_logged >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def add_task(self, task, priority=0):
+        'Add a new task or update the priority of an existing task'
+        self._log_suspended += 1
+        try:
+            evicted = super().add_task(task, priority)
+        finally:
+            self._log_suspended -= 1
+        self._log('add', (task, priority))
+        return evicted
+
+    def add_tasks(self, tasks):
+        'Add new tasks or update existing ones from an iterable of (task, priority) pairs'
+        tasks = list(tasks)
+        self._log_suspended += 1
+        try:
+            super().add_tasks(tasks)
+        finally:
+            self._log_suspended -= 1
+        self._log('add_many', tasks)
+
+    def remove_task(self, task):
+        'Mark an existing task as REMOVED. Raise KeyError if not found.'
+        super().remove_task(task)
+        self._log('remove', task)
+
+    def _pop_entry(self):
+        entry = super()._pop_entry()
+        self._log('remove', entry[2])
+        return entry
+
+    def checkpoint(self):
+        'Write the live tasks to the checkpoint file and start a new log.'
+        self.generation += 1
+        self.compact()  # the heap of live entries is saved as-is and won't need to be heapified again
+        checkpoint = {'generation': self.generation, 'entries': self.pq, 'count': next(self.counter)}
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(checkpoint, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+        self._start_log()
+
+    def close(self):
+        'Write a checkpoint and close the log file.'
+        if self._log_file is not None:
+            self.checkpoint()
+            self._log_file.close()
+            self._log_file = None
+
+
+class _Shard(PriorityQueue):
+    """Sub-queue of a ShardedPriorityQueue, where priorities are (priority, global count) keys"""
+
+    def add(self, task, key):
+        new = task not in self.entry_finder
+        self.add_task(task, key)
+        return new
+
+    def add_many(self, tasks):
+        num_tasks = self.num_tasks
+        self.add_tasks(tasks)
+        return self.num_tasks - num_tasks
+
+    def contains(self, task):
+        return task in self.entry_finder
+
+    def head(self):
+        entry = self._peek_entry()
+        return None if entry is None else (entry[0], entry[2])
+
+    def pop(self):
+        entry = self._pop_entry()
+        return entry[0], entry[2]
+
+    def pop_many_keyed(self, k):
+        'Remove and return a list of (at most) the k lowest (key, task) pairs.'
+        entries = []
+        while len(entries) < k and self.num_tasks:
+            entries.append(self.pop())
+        return entries
+
+    def pop_until_keyed(self, priority):
+        'Remove and return the list of all (key, task) pairs with a priority lower or equal to the given one.'
+        entries = []
+        head = self.head()
+        while head is not None and head[0][0] <= priority:
+            entries.append(self.pop())
+            head = self.head()
+        return entries
+
+
+def _shard_worker(conn):
+    'Serve the requests for a _Shard running in a worker process.'
+    shard = _Shard()
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        method, args = request
+        try:
+            result = getattr(shard, method)(*args)
+        except Exception as e:
+            conn.send((e, None, shard.head()))
+        else:
+            conn.send((None, result, shard.head()))
+    conn.close()
+
+
+class _ProcessShard:
+    """Proxy to a _Shard running in a worker process, which caches the head of the shard"""
+
+    def __init__(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_shard_worker, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self._head = None
+
+    def send(self, method, *args):
+        self.conn.send((method, args))
+
+    def recv(self):
+        error, result, self._head = self.conn.recv()
+        if error is not None:
+            raise error
+        return result
+
+    def call(self, method, *args):
+        self.send(method, *args)
+        return self.recv()
+
+    def add(self, task, key):
+        return self.call('add', task, key)
+
+    def add_many(self, tasks):
+        return self.call('add_many', tasks)
+
+    def remove_task(self, task):
+        return self.call('remove_task', task)
+
+    def contains(self, task):
+        return self.call('contains', task)
+
+    def priority_of(self, task):
+        return self.call('priority_of', task)
+
+    def compact(self):
+        return self.call('compact')
+
+    def head(self):
+        return self._head
+
+    def pop(self):
+        return self.call('pop')
+
+    def close(self):
+        self.conn.send(None)
+        self.process.join()
+        self.conn.close()
+
+
+class ShardedPriorityQueue(PriorityQueue):
+    """
+    Same API as PriorityQueue but spread over num_shards sub-queues by hash of the task.
+
+    Tasks are popped from the shard with the globally lowest head. Shards store
+    (priority, global count) keys, so tasks with the same priority are still popped in
+    insertion order across shards.
+
+    With processes=True, each shard lives in its own worker process and is driven through a pipe.
+    Bulk operations (add_tasks, pop_many, pop_until) run in parallel: they are sent to all the
+    shards before waiting for their replies, so they cost one or two round trips whatever the
+    number of tasks. Every other operation (add_task, remove_task, pop_task...) is a blocking
+    round trip to one worker, which is much slower than the in-process shards, so this mode only
+    pays off when the tasks are mostly added and popped in large batches. Tasks and priorities
+    must then be picklable, and close() must be called to stop the worker processes, after which
+    the queue can't be used anymore.
+    """
+
+    def __init__(self, name='', num_shards=4, processes=False):
+        self.name = name
+        self.processes = processes
+        if processes:
+            self.shards = [_ProcessShard() for _ in range(num_shards)]
+        else:
+            self.shards = [_Shard() for _ in range(num_shards)]
+        self.counter = itertools.count()     # unique sequence count, shared by all the shards
+        self.num_tasks = 0                   # track the number of tasks in the queue
+
+    def __contains__(self, task):
+        return self._shard_of(task).contains(task)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _check_open(self):
+        if not self.shards:
+            raise ValueError('operation on a closed ShardedPriorityQueue')
+
+    def _shard_of(self, task):
+        self._check_open()
+        return self.shards[hash(task) % len(self.shards)]
+
+    def _call_all(self, method, args_per_shard):
+        'Call a method on all the shards, in parallel with processes, and return the list of results.'
+        self._check_open()
+        if not self.processes:
+            return [getattr(shard, method)(*args) for shard, args in zip(self.shards, args_per_shard)]
+        for shard, args in zip(self.shards, args_per_shard):
+            shard.send(method, *args)
+        results = []
+        error = None
+        for shard in self.shards:
+            # read all the replies even after an error, so that the pipes stay in sync
+            try:
+                results.append(shard.recv())
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return results
+
+    def priority_of(self, task):
+        'Return the priority of a task in the queue. Raise KeyError if not found.'
+        return self._shard_of(task).priority_of(task)[0]
+
+    def add_task(self, task, priority=0):
+        'Add a new task or update the priority of an existing task'
+        if self._shard_of(task).add(task, (priority, next(self.counter))):
+            self.num_tasks += 1
+
+    def add_tasks(self, tasks):
+        'Add new tasks or update existing ones from an iterable of (task, priority) pairs'
+        self._check_open()
+        per_shard = [[] for _ in self.shards]
+        num_shards = len(self.shards)
+        for task, priority in tasks:
+            per_shard[hash(task) % num_shards].append((task, (priority, next(self.counter))))
+        self.num_tasks += sum(self._call_all('add_many', [(shard_tasks,) for shard_tasks in per_shard]))
+
+    def remove_task(self, task):
+        'Remove an existing task. Raise KeyError if not found.'
+        self._shard_of(task).remove_task(task)
+        self.num_tasks -= 1
+
+    def compact(self):
+        self._call_all('compact', [() for _ in self.shards])
+
+    def _best_shard(self):
+        self._check_open()
+        best_shard = None
+        best_head = None
+        for shard in self.shards:
+            head = shard.head()
+            if head is not None and (best_head is None or head[0] < best_head[0]):
+                best_shard = shard
+                best_head = head
+        return best_shard, best_head
+
+    def _peek_entry(self):
+        'Return the (priority, count, task) entry of the lowest priority task, or None if empty.'
+        _, head = self._best_shard()
+        if head is None:
+            return None
+        (priority, count), task = head
+        return priority, count, task
+
+    def _pop_entry(self):
+        shard, _ = self._best_shard()
+        if shard is None:
+            raise EmptyQueueError('pop from an empty priority queue')
+        (priority, count), task = shard.pop()
+        self.num_tasks -= 1
+        return priority, count, task
+
+    def pop_many(self, k):
+        'Remove and return a list of (at most) the k lowest priority tasks.'
+        if not self.processes:
+            return super().pop_many(k)
+        # pop k tasks from every shard at once, keep the k lowest and give the others back
+        per_shard = self._call_all('pop_many_keyed', [(k,) for _ in self.shards])
+        entries = list(heapq.merge(*per_shard, key=operator.itemgetter(0)))
+        self.num_tasks -= len(entries)
+        kept = entries[:k]
+        if len(entries) > k:
+            kept_counts = {key[1] for key, _ in kept}
+            surplus = [[(task, key) for key, task in shard_entries if key[1] not in kept_counts]
+                       for shard_entries in per_shard]
+            self.num_tasks += sum(self._call_all('add_many', [(shard_tasks,) for shard_tasks in surplus]))
+        return [task for _, task in kept]
+
+    def pop_until(self, priority):
+        'Remove and return the list of all tasks with a priority lower or equal to the given one.'
+        if not self.processes:
+            return super().pop_until(priority)
+        per_shard = self._call_all('pop_until_keyed', [(priority,) for _ in self.shards])
+        entries = list(heapq.merge(*per_shard, key=operator.itemgetter(0)))
+        self.num_tasks -= len(entries)
+        return [task for _, task in entries]
+
+    def close(self):
+        'Stop the worker processes of the shards, if any.'
+        if self.processes:
+            for shard in self.shards:
+                shard.close()
+            self.shards = []